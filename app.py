@@ -1,12 +1,32 @@
 import os
-from datetime import datetime, time
+import atexit
+import base64
+from datetime import datetime, time, timedelta
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session, flash
+from itertools import islice
+import hashlib
+import heapq
+import json
+import queue
+import re
+import sqlite3
+import threading
+import time as pytime
+import unicodedata
+from flask import Flask, Response, abort, render_template, request, jsonify, redirect, send_file, send_from_directory, url_for, session, flash
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
+from flask_migrate import Migrate
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import random
+import click
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
@@ -16,16 +36,54 @@ app.config['UPLOAD_FOLDER'] = 'static/ads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
 db = SQLAlchemy(app)
+migrate = Migrate(app, db)
 
 JAMENDO_CLIENT_ID = os.environ.get('JAMENDO_CLIENT_ID', '44c2831a')
 JAMENDO_CLIENT_SECRET = os.environ.get('JAMENDO_CLIENT_SECRET', 'a3ef8b81412651e6ca6ac4724b31e95e')
-
-# Variable global para mantener el estado de la radio (sincronizado para todos los oyentes)
-radio_state = {
-    'current_track_index': 0,
-    'last_update': None,
-    'current_playlist_id': None
-}
+JAMENDO_API_URL = os.environ.get('JAMENDO_API_URL', 'https://api.jamendo.com/v3.0')
+# Máximo de resultados por página que acepta la API de Jamendo
+JAMENDO_PAGE_SIZE = 200
+# Cache de respuestas de Jamendo: TTL en segundos por endpoint y tamaño máximo (LRU).
+# Con JAMENDO_CACHE_PATH se usa un archivo SQLite en lugar de memoria.
+JAMENDO_CACHE_TTLS = {'search': 600, 'artist': 3600, 'popular': 3600, 'genre': 3600, 'playlists': 3600}
+JAMENDO_CACHE_SIZE = int(os.environ.get('JAMENDO_CACHE_SIZE', '512'))
+JAMENDO_CACHE_PATH = os.environ.get('JAMENDO_CACHE_PATH')
+# Cargas masivas más grandes que esto se hacen como trabajo en segundo plano
+JAMENDO_SYNC_LIMIT = 50
+# Un trabajo 'running' sin avance en este tiempo se considera interrumpido
+IMPORT_JOB_STALE_SECONDS = 120
+# Cada cuánto cada proceso busca trabajos pendientes o interrumpidos para retomarlos
+IMPORT_JOB_SWEEP_SECONDS = 60
+# Cada cuánto un trabajo en curso renueva updated_at (también en medio de una tanda larga)
+IMPORT_JOB_HEARTBEAT_SECONDS = 30
+
+# Proxy local de audio (/media/track/<id>): descarga cada track una vez a una cache en disco
+MEDIA_PROXY_ENABLED = os.environ.get('MEDIA_PROXY_ENABLED', '0') == '1'
+MEDIA_CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_cache'))
+MEDIA_CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_MB', '2048')) * 1024 * 1024
+# Cuántos tracks siguientes de la rotación se precargan en cada cambio
+MEDIA_PREFETCH_COUNT = 3
+
+# Duraciones por defecto (segundos) cuando el item no tiene duración cargada
+DEFAULT_TRACK_DURATION = 180
+DEFAULT_AD_DURATION = 30
+# Margen para que un cliente que termina apenas antes del corte reciba el siguiente item
+TIMELINE_GRACE_SECONDS = 2
+# Transiciones atrasadas que se registran en el historial al ponerse al día
+TIMELINE_MAX_CATCHUP = 10
+# Items que se simulan uno por uno (con sus tandas) antes de saltar directo por duraciones
+TIMELINE_SIMULATE_MAX = 5000
+# Recompilación periódica del horario (cubre cambios hechos desde otro worker)
+SCHEDULE_REFRESH_SECONDS = 300
+# Recarga periódica de las reglas de AdConfig
+AD_RULES_REFRESH_SECONDS = 300
+# Historial de reproducción: escritura diferida por lotes (desactivar con HISTORY_ASYNC=0)
+HISTORY_ASYNC = os.environ.get('HISTORY_ASYNC', '1') != '0'
+HISTORY_BATCH_SIZE = 50
+HISTORY_FLUSH_SECONDS = 5
+
+# Estado compartido de /api/radio/stream entre workers: vacío = fila en la base, redis://... = Redis
+RADIO_STATE_URL = os.environ.get('RADIO_STATE_URL', '')
 
 # ===================================
 # MODELOS DE BASE DE DATOS
@@ -46,9 +104,23 @@ class Playlist(db.Model):
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text)
     is_active = db.Column(db.Boolean, default=True)
+    # Política de rotación: modo (ROTATION_MODES), separación mínima entre tracks del mismo
+    # artista/álbum (0 = sin separar) y semilla (NULL = id de la playlist)
+    rotation_mode = db.Column(db.String(20), nullable=False, default='sequential', server_default='sequential')
+    rotation_separation = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rotation_separate_by = db.Column(db.String(10), nullable=False, default='artist', server_default='artist')
+    rotation_seed = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+def track_search_vector(title, artist, album):
+    """tsvector de título/artista/álbum; la misma expresión respalda el índice GIN en Postgres"""
+    empty, space = db.literal_column("''"), db.literal_column("' '")
+    return db.func.to_tsvector(
+        db.literal_column("'simple'::regconfig"),
+        db.func.coalesce(title, empty) + space + db.func.coalesce(artist, empty) + space + db.func.coalesce(album, empty)
+    )
+
 class Track(db.Model):
     __tablename__ = 'tracks'
     id = db.Column(db.Integer, primary_key=True)
@@ -58,9 +130,27 @@ class Track(db.Model):
     duration = db.Column(db.Integer)
     audio_url = db.Column(db.Text, nullable=False)
     cover_url = db.Column(db.Text)
+    # Identidad para detectar duplicados: id de Jamendo y "artista|título" normalizados
+    jamendo_id = db.Column(db.String(32))
+    dedupe_key = db.Column(db.String(255))
+    # Sonoridad integrada (LUFS) y pico (dBFS); NULL hasta que corre `flask analyze-loudness`
+    loudness = db.Column(db.Float)
+    peak = db.Column(db.Float)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # Búsqueda de duplicados por URL en todas las importaciones de Jamendo
+        db.Index('ix_tracks_audio_url', 'audio_url', unique=True),
+        # Paginación por keyset ordenada por título en /api/tracks
+        db.Index('ix_tracks_title_id', 'title', 'id'),
+        db.Index('ix_tracks_jamendo_id', 'jamendo_id'),
+        db.Index('ix_tracks_dedupe_key', 'dedupe_key'),
+        # Búsqueda de texto completo (solo Postgres; en otros motores se usa TrackSearchIndex)
+        db.Index('ix_tracks_search', track_search_vector(title, artist, album),
+                 postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+
 class PlaylistTrack(db.Model):
     __tablename__ = 'playlist_tracks'
     id = db.Column(db.Integer, primary_key=True)
@@ -68,6 +158,11 @@ class PlaylistTrack(db.Model):
     track_id = db.Column(db.Integer, db.ForeignKey('tracks.id', ondelete='CASCADE'))
     position = db.Column(db.Integer, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_playlist_tracks_playlist_position', 'playlist_id', 'position'),
+        db.UniqueConstraint('playlist_id', 'track_id', name='uq_playlist_tracks_playlist_track'),
+    )
+
 class Ad(db.Model):
     __tablename__ = 'ads'
     id = db.Column(db.Integer, primary_key=True)
@@ -75,6 +170,8 @@ class Ad(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     duration = db.Column(db.Integer)
     ad_type = db.Column(db.String(20), default='commercial')
+    loudness = db.Column(db.Float)
+    peak = db.Column(db.Float)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -87,6 +184,10 @@ class Schedule(db.Model):
     end_time = db.Column(db.Time, nullable=False)
     is_active = db.Column(db.Boolean, default=True)
 
+    __table_args__ = (
+        db.Index('ix_schedules_day_times', 'day_of_week', 'start_time', 'end_time'),
+    )
+
 class AdConfig(db.Model):
     __tablename__ = 'ad_config'
     id = db.Column(db.Integer, primary_key=True)
@@ -104,31 +205,259 @@ class PlaybackHistory(db.Model):
     played_at = db.Column(db.DateTime, default=datetime.utcnow)
     duration_played = db.Column(db.Integer)
 
+    __table_args__ = (
+        db.Index('ix_playback_history_played_at', 'played_at'),
+        # Última publicidad y canciones desde entonces (tandas publicitarias)
+        db.Index('ix_playback_history_ad_played_at', 'ad_id', 'played_at'),
+        db.Index('ix_playback_history_track_played_at', 'track_id', 'played_at'),
+    )
+
+class ImportJob(db.Model):
+    __tablename__ = 'import_jobs'
+    id = db.Column(db.Integer, primary_key=True)
+    playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id', ondelete='CASCADE'))
+    source_type = db.Column(db.String(20), nullable=False)
+    params = db.Column(db.Text)  # JSON con los argumentos de la fuente (género, búsqueda)
+    status = db.Column(db.String(20), default='queued')  # queued, running, done, error
+    total = db.Column(db.Integer, nullable=False)
+    fetched = db.Column(db.Integer, default=0)
+    added = db.Column(db.Integer, default=0)
+    skipped = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_import_jobs_status', 'status'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'playlist_id': self.playlist_id,
+            'source_type': self.source_type,
+            'params': json.loads(self.params or '{}'),
+            'status': self.status,
+            'total': self.total,
+            'fetched': self.fetched,
+            'added': self.added,
+            'skipped': self.skipped,
+            'progress': round(self.fetched / self.total, 3) if self.total else 1.0,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class RadioState(db.Model):
+    """Estado compartido por todos los workers (una fila por clave): el cursor de /api/radio/stream
+    y el documento de la línea de tiempo de la emisión"""
+    __tablename__ = 'radio_state'
+    key = db.Column(db.String(50), primary_key=True)
+    playlist_id = db.Column(db.Integer)
+    track_index = db.Column(db.Integer, nullable=False, default=0)
+    # Documento JSON (estado de BroadcastTimeline)
+    data = db.Column(db.Text)
+    # Se incrementa en cada cambio; los UPDATE se condicionan a la versión leída
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # ===================================
 # DECORADORES Y UTILIDADES
 # ===================================
 
-def search_jamendo_tracks(query='', genre='', limit=20):
-    try:
-        url = 'https://api.jamendo.com/v3.0/tracks/'
-        params = {
-            'client_id': JAMENDO_CLIENT_ID,
-            'format': 'json',
-            'limit': limit,
-            'audioformat': 'mp32',
-            'include': 'musicinfo'
-        }
-        if query: params['search'] = query
-        if genre: params['tags'] = genre
-
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        print(f"DEBUG: Respuesta Jamendo -> {data}") 
+class MemoryCacheBackend:
+    """Backend de cache en memoria del proceso con desalojo LRU"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # clave -> (guardado_en, valor)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, stored_at, value):
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+class SQLiteCacheBackend:
+    """Backend de cache en un archivo SQLite local: sobrevive a los reinicios"""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(key TEXT PRIMARY KEY, stored_at REAL, accessed_at REAL, value TEXT)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_accessed_at ON cache (accessed_at)')
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute('SELECT stored_at, value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (pytime.time(), key))
+            self._conn.commit()
+        return row[0], json.loads(row[1])
+
+    def set(self, key, stored_at, value):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, stored_at, accessed_at, value) VALUES (?, ?, ?, ?)',
+                (key, stored_at, pytime.time(), json.dumps(value))
+            )
+            self._conn.execute(
+                'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+class ResponseCache:
+    """Cache TTL + LRU de respuestas externas con stale-while-revalidate.
+
+    La clave se arma con los parámetros normalizados (minúsculas, espacios
+    colapsados, vacíos descartados). Dentro del TTL del endpoint se responde
+    desde la cache; durante la ventana `stale` se devuelve el valor viejo y
+    se refresca en segundo plano; si el origen falla se sirve lo último
+    guardado.
+    """
+
+    def __init__(self, backend, ttls, default_ttl=600, stale_factor=1.0):
+        self.backend = backend
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.stale_factor = stale_factor
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        self.stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'refreshes': 0, 'errors': 0}
+
+    @staticmethod
+    def make_key(endpoint, params):
+        normalized = {}
+        for name, value in params.items():
+            if isinstance(value, str):
+                value = ' '.join(value.lower().split())
+            if value not in ('', None):
+                normalized[name] = value
+        return f"{endpoint}:{json.dumps(normalized, sort_keys=True)}"
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _refresh(self, key, fetch):
+        try:
+            self.backend.set(key, pytime.time(), fetch())
+            self._count('refreshes')
+        except Exception as e:
+            self._count('errors')
+            print(f"Error refrescando cache ({key}): {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def get_or_fetch(self, endpoint, params, fetch):
+        key = self.make_key(endpoint, params)
+        ttl = self.ttls.get(endpoint, self.default_ttl)
+        entry = self.backend.get(key)
+
+        if entry is not None:
+            stored_at, value = entry
+            age = pytime.time() - stored_at
+            if age < ttl:
+                self._count('hits')
+                return value
+            if age < ttl * (1 + self.stale_factor):
+                self._count('stale_hits')
+                with self._lock:
+                    start = key not in self._refreshing
+                    self._refreshing.add(key)
+                if start:
+                    self._executor.submit(self._refresh, key, fetch)
+                return value
+
+        self._count('misses')
+        try:
+            value = fetch()
+        except Exception:
+            self._count('errors')
+            if entry is not None:
+                return entry[1]
+            raise
+        self.backend.set(key, pytime.time(), value)
+        return value
+
+    def info(self):
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        stats['entries'] = len(self.backend)
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 3) if lookups else None
+        stats['backend'] = type(self.backend).__name__
+        return stats
+
+class JamendoClient:
+    """Cliente de la API de Jamendo.
+
+    Usa una sesión HTTP con conexiones keep-alive reutilizables, timeouts de
+    conexión/lectura y reintentos con backoff exponencial ante 429/5xx. La URL
+    base es configurable para poder apuntarlo a un servidor stub local.
+    """
+
+    def __init__(self, client_id, base_url=None, timeout=(3.05, 10), retries=3,
+                 backoff=0.5, pool_size=10, max_workers=4, cache=None):
+        self.client_id = client_id
+        self.cache = cache
+        self.base_url = (base_url or JAMENDO_API_URL).rstrip('/')
+        self.timeout = timeout
+        self.max_workers = max_workers
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, path, params):
+        params = dict(params, client_id=self.client_id, format='json')
+        response = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
 
-        if 'results' not in data:
-            return []
+    def get(self, path, endpoint=None, **params):
+        """GET a la API (a través de la cache si se indica `endpoint`); devuelve el JSON"""
+        if self.cache is None or endpoint is None:
+            return self._request(path, params)
+        return self.cache.get_or_fetch(endpoint, dict(params, path=path),
+                                       lambda: self._request(path, params))
 
+    @staticmethod
+    def parse_tracks(data):
+        """Convierte la respuesta de /tracks/ al formato interno de la radio"""
         tracks = []
         for track in data.get('results', []):
             tracks.append({
@@ -141,36 +470,68 @@ def search_jamendo_tracks(query='', genre='', limit=20):
                 'cover_url': track.get('album_image', track.get('image', ''))
             })
         return tracks
+
+    def tracks(self, endpoint=None, **params):
+        params.setdefault('audioformat', 'mp32')
+        return self.parse_tracks(self.get('/tracks/', endpoint, **params))
+
+    def search(self, query='', genre='', limit=20, offset=0):
+        params = {'limit': limit, 'offset': offset, 'include': 'musicinfo'}
+        if query: params['search'] = query
+        if genre: params['tags'] = genre
+        return self.tracks('search', **params)
+
+    def by_artist(self, artist_name='', limit=50, offset=0):
+        return self.tracks('artist', artist_name=artist_name, limit=limit, offset=offset)
+
+    def popular(self, limit=50, offset=0):
+        return self.tracks('popular', order='popularity_total', include='musicinfo', limit=limit, offset=offset)
+
+    def by_genre(self, genre='rock', limit=50, offset=0):
+        return self.tracks('genre', tags=genre, order='popularity_total', limit=limit, offset=offset)
+
+    def playlists(self, limit=20):
+        return self.get('/playlists/tracks/', 'playlists', limit=limit)
+
+    def fetch_many(self, calls):
+        """Ejecuta varias consultas en paralelo: calls = [(método, kwargs), ...]; respeta el orden"""
+        if len(calls) == 1:
+            method, kwargs = calls[0]
+            return [getattr(self, method)(**kwargs)]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [pool.submit(getattr(self, method), **kwargs) for method, kwargs in calls]
+            return [future.result() for future in futures]
+
+    def fetch_pages(self, method, limit, page_size=JAMENDO_PAGE_SIZE, **kwargs):
+        """Pide `limit` tracks en páginas concurrentes (Jamendo limita el tamaño de página)"""
+        calls = [
+            (method, dict(kwargs, limit=min(page_size, limit - offset), offset=offset))
+            for offset in range(0, limit, page_size)
+        ]
+        tracks = []
+        for page in self.fetch_many(calls):
+            tracks.extend(page)
+        return tracks[:limit]
+
+if JAMENDO_CACHE_PATH:
+    jamendo_cache = ResponseCache(SQLiteCacheBackend(JAMENDO_CACHE_PATH, JAMENDO_CACHE_SIZE), JAMENDO_CACHE_TTLS)
+else:
+    jamendo_cache = ResponseCache(MemoryCacheBackend(JAMENDO_CACHE_SIZE), JAMENDO_CACHE_TTLS)
+
+jamendo = JamendoClient(JAMENDO_CLIENT_ID, cache=jamendo_cache)
+
+def search_jamendo_tracks(query='', genre='', limit=20):
+    """Busca tracks en Jamendo por texto y/o género"""
+    try:
+        return jamendo.fetch_pages('search', limit, query=query, genre=genre)
     except Exception as e:
         print(f"Error buscando en Jamendo: {e}")
         return []
+
 def get_jamendo_tracks_by_artist(artist_name='', limit=50):
     """Obtiene tracks de un artista específico de Jamendo"""
     try:
-        url = 'https://api.jamendo.com/v3.0/tracks/'
-        params = {
-            'client_id': JAMENDO_CLIENT_ID,
-            'format': 'json',
-            'limit': limit,
-            'audioformat': 'mp32',
-            'artist_name': artist_name
-        }
-        
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        tracks = []
-        for track in data.get('results', []):
-            tracks.append({
-                'jamendo_id': track['id'],
-                'title': track['name'],
-                'artist': track['artist_name'],
-                'album': track.get('album_name', ''),
-                'duration': track['duration'],
-                'audio_url': track['audio'],
-                'cover_url': track.get('album_image', track.get('image', ''))
-            })
-        return tracks
+        return jamendo.fetch_pages('by_artist', limit, artist_name=artist_name)
     except Exception as e:
         print(f"Error obteniendo tracks de artista: {e}")
         return []
@@ -178,31 +539,7 @@ def get_jamendo_tracks_by_artist(artist_name='', limit=50):
 def get_jamendo_popular_tracks(limit=50):
     """Obtiene tracks populares de Jamendo para iniciar la radio"""
     try:
-        url = 'https://api.jamendo.com/v3.0/tracks/'
-        params = {
-            'client_id': JAMENDO_CLIENT_ID,
-            'format': 'json',
-            'limit': limit,
-            'audioformat': 'mp32',
-            'order': 'popularity_total',
-            'include': 'musicinfo'
-        }
-        
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        tracks = []
-        for track in data.get('results', []):
-            tracks.append({
-                'jamendo_id': track['id'],
-                'title': track['name'],
-                'artist': track['artist_name'],
-                'album': track.get('album_name', ''),
-                'duration': track['duration'],
-                'audio_url': track['audio'],
-                'cover_url': track.get('album_image', track.get('image', ''))
-            })
-        return tracks
+        return jamendo.fetch_pages('popular', limit)
     except Exception as e:
         print(f"Error obteniendo tracks populares: {e}")
         return []
@@ -210,62 +547,145 @@ def get_jamendo_popular_tracks(limit=50):
 def get_jamendo_tracks_by_genre(genre='rock', limit=50):
     """Obtiene tracks por género de Jamendo"""
     try:
-        url = 'https://api.jamendo.com/v3.0/tracks/'
-        params = {
-            'client_id': JAMENDO_CLIENT_ID,
-            'format': 'json',
-            'limit': limit,
-            'audioformat': 'mp32',
-            'tags': genre,
-            'order': 'popularity_total'
-        }
-        
-        response = requests.get(url, params=params)
-        data = response.json()
-        
-        tracks = []
-        for track in data.get('results', []):
-            tracks.append({
-                'jamendo_id': track['id'],
-                'title': track['name'],
-                'artist': track['artist_name'],
-                'album': track.get('album_name', ''),
-                'duration': track['duration'],
-                'audio_url': track['audio'],
-                'cover_url': track.get('album_image', track.get('image', ''))
-            })
-        return tracks
+        return jamendo.fetch_pages('by_genre', limit, genre=genre)
     except Exception as e:
         print(f"Error obteniendo tracks por género: {e}")
         return []
 
+def get_jamendo_playlists(genre='', limit=20):
+    """Obtiene playlists predefinidas de Jamendo"""
+    try:
+        return jamendo.playlists(limit=limit)
+    except Exception as e:
+        print(f"Error obteniendo playlists de Jamendo: {e}")
+        return []
+
+# ===================================
+# DETECCIÓN DE DUPLICADOS
+# ===================================
+
+# Diferencia máxima de duración (segundos) para considerar que dos tracks son la misma grabación
+DUPLICATE_DURATION_TOLERANCE = 5
+
+def normalize_track_text(text):
+    """Texto comparable: sin acentos, minúsculas, sin paréntesis/corchetes ni 'feat.'"""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r'[\(\[].*?[\)\]]', ' ', text)
+    text = re.sub(r'\b(feat|ft|featuring)\b.*', ' ', text)
+    return ' '.join(re.findall(r'\w+', text))
+
+def track_dedupe_key(title, artist):
+    return f"{normalize_track_text(artist)}|{normalize_track_text(title)}"[:255]
+
+def jamendo_id_from_url(audio_url):
+    """Las URLs de audio de Jamendo llevan el id del track en ?trackid="""
+    match = re.search(r'[?&]trackid=(\d+)', audio_url or '')
+    return match.group(1) if match else None
+
+def track_identity(title, artist, audio_url, jamendo_id=None):
+    """Columnas de identidad de un track nuevo (jamendo_id y dedupe_key)"""
+    return {
+        'jamendo_id': str(jamendo_id) if jamendo_id else jamendo_id_from_url(audio_url),
+        'dedupe_key': track_dedupe_key(title, artist)
+    }
+
+def durations_match(a, b):
+    return not a or not b or abs(a - b) <= DUPLICATE_DURATION_TOLERANCE
+
+class DuplicateIndex:
+    """Índice hash de los tracks existentes que pueden coincidir con un lote de candidatos.
+
+    Se carga con una sola consulta (por audio_url, jamendo_id o clave
+    normalizada) y después cada verificación es un acceso a diccionario.
+    `add` registra los candidatos nuevos del mismo lote para que también se
+    detecten repetidos entre ellos; su referencia es la audio_url a insertar.
+    """
+
+    def __init__(self, candidates):
+        self._by_url = {}
+        self._by_jamendo = {}
+        self._by_key = {}
+
+        urls = {c['audio_url'] for c in candidates}
+        jamendo_ids = {c['jamendo_id'] for c in candidates if c.get('jamendo_id')}
+        keys = {c['dedupe_key'] for c in candidates}
+        if not urls:
+            return
+        conditions = [Track.audio_url.in_(urls), Track.dedupe_key.in_(keys)]
+        if jamendo_ids:
+            conditions.append(Track.jamendo_id.in_(jamendo_ids))
+        rows = db.session.query(
+            Track.id, Track.audio_url, Track.jamendo_id, Track.dedupe_key, Track.duration
+        ).filter(db.or_(*conditions)).order_by(Track.id).all()
+        for track_id, audio_url, jamendo_id, dedupe_key, duration in rows:
+            self._register(track_id, audio_url, jamendo_id, dedupe_key, duration)
+
+    def _register(self, ref, audio_url, jamendo_id, dedupe_key, duration):
+        self._by_url.setdefault(audio_url, ref)
+        if jamendo_id:
+            self._by_jamendo.setdefault(jamendo_id, ref)
+        if dedupe_key:
+            self._by_key.setdefault(dedupe_key, []).append((ref, duration))
+
+    def find(self, candidate):
+        """id del track existente (o audio_url del candidato previo del lote) que coincide, o None"""
+        ref = self._by_url.get(candidate['audio_url'])
+        if ref is None and candidate.get('jamendo_id'):
+            ref = self._by_jamendo.get(candidate['jamendo_id'])
+        if ref is None:
+            for existing, duration in self._by_key.get(candidate['dedupe_key'], ()):
+                if durations_match(duration, candidate.get('duration')):
+                    return existing
+        return ref
+
+    def add(self, candidate, ref=None):
+        ref = candidate['audio_url'] if ref is None else ref
+        self._register(ref, candidate['audio_url'], candidate.get('jamendo_id'),
+                       candidate['dedupe_key'], candidate.get('duration'))
+
+def find_duplicate_track(title, artist, audio_url, duration=None, jamendo_id=None):
+    """Track existente que corresponde a la misma canción, o None"""
+    candidate = dict(track_identity(title, artist, audio_url, jamendo_id), audio_url=audio_url, duration=duration)
+    track_id = DuplicateIndex([candidate]).find(candidate)
+    return db.session.get(Track, track_id) if track_id else None
+
 @app.route('/admin/playlists/<int:playlist_id>/add-jamendo-track', methods=['POST'])
 def add_jamendo_track_to_playlist(playlist_id):
     # 1. Crear el track en la DB si no existe
     audio_url = request.form.get('audio_url')
-    track = Track.query.filter_by(audio_url=audio_url).first()
+    title = request.form.get('title')
+    artist = request.form.get('artist')
+    duration = int(request.form.get('duration') or 0)
+    jamendo_id = request.form.get('jamendo_id')
+    track = find_duplicate_track(title, artist, audio_url, duration, jamendo_id)
     
     if not track:
         track = Track(
-            title=request.form.get('title'),
-            artist=request.form.get('artist'),
+            title=title,
+            artist=artist,
             album=request.form.get('album'),
-            duration=int(request.form.get('duration', 0)),
+            duration=duration,
             audio_url=audio_url,
-            cover_url=request.form.get('cover_url')
+            cover_url=request.form.get('cover_url'),
+            **track_identity(title, artist, audio_url, jamendo_id)
         )
         db.session.add(track)
         db.session.flush() # Para obtener el track.id
 
-    # 2. Vincularlo a la playlist
-    last_pos = db.session.query(db.func.max(PlaylistTrack.position)).filter_by(playlist_id=playlist_id).scalar() or 0
+    # 2. Vincularlo a la playlist (una sola vez por playlist)
+    if PlaylistTrack.query.filter_by(playlist_id=playlist_id, track_id=track.id).first():
+        db.session.commit()
+        return jsonify({'status': 'exists'})
+
     new_rel = PlaylistTrack(
         playlist_id=playlist_id,
         track_id=track.id,
-        position=last_pos + 1
+        position=new_playlist_position(playlist_id, request.form.get('index', type=int))
     )
     db.session.add(new_rel)
     db.session.commit()
+    rotation_engine.invalidate(playlist_id)
     
     return jsonify({'status': 'success'})
 
@@ -273,7 +693,9 @@ def add_jamendo_track_to_playlist(playlist_id):
 def import_jamendo_track():
     data = request.json
     # Verificamos si ya existe para no duplicar
-    existing_track = Track.query.filter_by(audio_url=data['audio_url']).first()
+    existing_track = find_duplicate_track(
+        data['title'], data['artist'], data['audio_url'], data['duration'], data.get('jamendo_id')
+    )
     
     if not existing_track:
         new_track = Track(
@@ -282,7 +704,8 @@ def import_jamendo_track():
             album=data.get('album', ''),
             duration=data['duration'],
             audio_url=data['audio_url'],
-            cover_url=data.get('cover_url', '')
+            cover_url=data.get('cover_url', ''),
+            **track_identity(data['title'], data['artist'], data['audio_url'], data.get('jamendo_id'))
         )
         db.session.add(new_track)
         db.session.commit()
@@ -290,22 +713,6 @@ def import_jamendo_track():
     
     return jsonify({'track_id': existing_track.id})
 
-def get_jamendo_playlists(genre='', limit=20):
-    """Obtiene playlists predefinidas de Jamendo"""
-    try:
-        url = 'https://api.jamendo.com/v3.0/playlists/tracks/'
-        params = {
-            'client_id': JAMENDO_CLIENT_ID,
-            'format': 'json',
-            'limit': limit
-        }
-
-        response = requests.get(url, params=params)
-        return response.json()
-    except Exception as e:
-        print(f"Error obteniendo playlists de Jamendo: {e}")
-        return []
-
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -314,53 +721,1862 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+PlaylistInfo = namedtuple('PlaylistInfo', ['id', 'name', 'is_active'])
+ScheduleSlot = namedtuple('ScheduleSlot', ['id', 'playlist_id', 'day_of_week', 'start_time', 'end_time'])
+
+def _time_to_us(t):
+    """Convierte un datetime.time a microsegundos desde medianoche (para comparar con bisect)"""
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1_000_000 + t.microsecond
+
+class CompiledSchedule:
+    """Horario semanal compilado en memoria: búsqueda O(log n) sin SQL.
+
+    Cada día se aplana en segmentos disjuntos ordenados; el inicio de cada
+    segmento es un posible cambio de programación. Se recompila cuando el
+    admin crea o borra horarios/playlists y, por las dudas de otros workers,
+    como máximo cada SCHEDULE_REFRESH_SECONDS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._compiled = None
+        self._compiled_at = None
+        self._cached = None  # (válido_hasta, resultado de lookup)
+
+    def invalidate(self):
+        with self._lock:
+            self._compiled = None
+            self._cached = None
+
+    def _compile(self):
+        playlists = {
+            p.id: PlaylistInfo(p.id, p.name, p.is_active)
+            for p in Playlist.query.order_by(Playlist.id).all()
+        }
+        default = next((p for p in playlists.values() if p.is_active), None)
+
+        entries = [[] for _ in range(7)]
+        for s in Schedule.query.filter(Schedule.is_active == True).order_by(
+            Schedule.day_of_week, Schedule.start_time, Schedule.id
+        ).all():
+            entries[s.day_of_week].append(
+                ScheduleSlot(s.id, s.playlist_id, s.day_of_week, s.start_time, s.end_time)
+            )
+
+        days = []
+        for day_entries in entries:
+            # Intervalos cerrados [inicio, fin] -> semiabiertos [inicio, fin + 1µs)
+            bounds = sorted({_time_to_us(e.start_time) for e in day_entries} |
+                            {_time_to_us(e.end_time) + 1 for e in day_entries} | {0})
+            seg_starts, seg_entries = [], []
+            for point in bounds:
+                winner = next((e for e in day_entries
+                               if _time_to_us(e.start_time) <= point <= _time_to_us(e.end_time)), None)
+                if seg_entries and seg_entries[-1] == winner:
+                    continue
+                seg_starts.append(point)
+                seg_entries.append(winner)
+            days.append((seg_starts, seg_entries, [_time_to_us(e.start_time) for e in day_entries], day_entries))
+
+        return {'playlists': playlists, 'default': default, 'days': days}
+
+    def _get(self, now):
+        compiled = self._compiled
+        if compiled is None or (now - self._compiled_at).total_seconds() > SCHEDULE_REFRESH_SECONDS:
+            compiled = self._compile()
+            with self._lock:
+                self._compiled = compiled
+                self._compiled_at = now
+                self._cached = None
+        return compiled
+
+    def lookup(self, now=None):
+        """Devuelve (playlist, horario, próximo cambio); el resultado se reutiliza hasta ese cambio"""
+        now = now or datetime.now()
+        cached = self._cached
+        if cached and cached[0][0] <= now < cached[0][1]:
+            return cached[1]
+
+        compiled = self._get(now)
+        seg_starts, seg_entries, _, _ = compiled['days'][now.weekday()]
+        t = _time_to_us(now.time())
+        i = bisect_right(seg_starts, t) - 1
+        schedule = seg_entries[i]
+
+        midnight = datetime.combine(now.date(), time.min)
+        if i + 1 < len(seg_starts):
+            next_change = midnight + timedelta(microseconds=seg_starts[i + 1])
+        else:
+            next_change = midnight + timedelta(days=1)
+
+        if schedule:
+            playlist = compiled['playlists'].get(schedule.playlist_id)
+        else:
+            playlist = compiled['default']
+
+        result = (playlist, schedule, next_change)
+        segment_start = midnight + timedelta(microseconds=seg_starts[i])
+        valid_until = min(next_change, self._compiled_at + timedelta(seconds=SCHEDULE_REFRESH_SECONDS))
+        with self._lock:
+            if self._compiled is compiled:
+                self._cached = ((segment_start, valid_until), result)
+        return result
+
+    def upcoming(self, now=None):
+        """Próximo horario programado que empieza después de `now` (dentro de la semana)"""
+        now = now or datetime.now()
+        compiled = self._get(now)
+        t = _time_to_us(now.time())
+        for days_ahead in range(8):
+            day = (now.weekday() + days_ahead) % 7
+            _, _, starts, day_entries = compiled['days'][day]
+            i = bisect_right(starts, t) if days_ahead == 0 else 0
+            if i < len(day_entries):
+                schedule = day_entries[i]
+                start = datetime.combine(now.date() + timedelta(days=days_ahead), schedule.start_time)
+                return schedule, compiled['playlists'].get(schedule.playlist_id), start
+        return None
+
+compiled_schedule = CompiledSchedule()
+
+def get_current_slot(now=None):
+    """Obtiene (playlist, horario) vigentes según día y hora; horario es None si no hay programación"""
+    playlist, schedule, _ = compiled_schedule.lookup(now)
+    return playlist, schedule
+
 def get_current_playlist():
     """Obtiene la playlist actual según día y hora"""
-    now = datetime.now()
-    day_of_week = now.weekday()  # 0=lunes, 6=domingo
-    current_time = now.time()
-    
-    schedule = Schedule.query.filter(
-        Schedule.day_of_week == day_of_week,
-        Schedule.start_time <= current_time,
-        Schedule.end_time >= current_time,
-        Schedule.is_active == True
-    ).first()
-    
-    if schedule:
-        return Playlist.query.get(schedule.playlist_id)
-    
-    # Si no hay horario, devolver playlist por defecto
-    return Playlist.query.filter_by(is_active=True).first()
-
-def should_play_ad():
-    """Determina si debe reproducirse una publicidad"""
-    # Contar canciones reproducidas desde último ad
-    last_ad = PlaybackHistory.query.filter(
-        PlaybackHistory.ad_id.isnot(None)
-    ).order_by(PlaybackHistory.played_at.desc()).first()
-    
-    if not last_ad:
-        tracks_since_ad = PlaybackHistory.query.filter(
-            PlaybackHistory.track_id.isnot(None)
-        ).count()
+    return get_current_slot()[0]
+
+# ===================================
+# TANDAS PUBLICITARIAS
+# ===================================
+
+def serialize_ad(ad):
+    """Convierte un Ad en el dict que devuelven las APIs de reproducción"""
+    return {
+        'type': 'ad',
+        'id': ad.id,
+        'title': ad.title,
+        'audio_url': f"/media/ads/{ad.filename}",
+        'duration': ad.duration,
+        'gain': loudness_gain(ad.loudness, ad.peak)
+    }
+
+# Disparadores soportados por AdConfig.trigger_type
+AD_TRIGGERS = {
+    # Cantidad de canciones desde la última publicidad
+    'track_count': lambda counters, value, now: counters['tracks_since_ad'] >= value,
+    # Minutos transcurridos desde la última publicidad
+    'time': lambda counters, value, now: (
+        counters['tracks_since_ad'] > 0 and
+        (now - counters['last_ad_at']).total_seconds() >= value * 60
+    ),
+}
+
+class AdBreakScheduler:
+    """Decide las tandas publicitarias con contadores incrementales.
+
+    Los contadores (canciones desde la última publicidad y hora de la última
+    publicidad) se reconstruyen del historial una sola vez al arrancar y luego
+    se actualizan con cada item emitido. Las reglas activas de AdConfig se
+    evalúan por prioridad (mayor primero).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = None
+        self._rules = None
+        self._rules_loaded_at = None
+
+    def _rebuild_counters(self):
+        last_ad = PlaybackHistory.query.filter(
+            PlaybackHistory.ad_id.isnot(None)
+        ).order_by(PlaybackHistory.played_at.desc()).first()
+
+        tracks = PlaybackHistory.query.filter(PlaybackHistory.track_id.isnot(None))
+        if last_ad:
+            tracks = tracks.filter(PlaybackHistory.played_at > last_ad.played_at)
+        return {
+            'tracks_since_ad': tracks.count(),
+            'last_ad_at': last_ad.played_at if last_ad else datetime.utcnow()
+        }
+
+    def _load_rules(self):
+        configs = db.session.query(AdConfig, Ad).join(
+            Ad, Ad.id == AdConfig.ad_id
+        ).filter(
+            AdConfig.is_active == True,
+            Ad.is_active == True
+        ).order_by(AdConfig.priority.desc(), AdConfig.id).all()
+        return [
+            (config.trigger_type, config.trigger_value, serialize_ad(ad))
+            for config, ad in configs
+            if config.trigger_type in AD_TRIGGERS
+        ]
+
+    def counters(self):
+        """Contadores actuales (se reconstruyen del historial la primera vez)"""
+        if self._counters is None:
+            counters = self._rebuild_counters()
+            with self._lock:
+                if self._counters is None:
+                    self._counters = counters
+        return self._counters
+
+    def rules(self):
+        now = datetime.utcnow()
+        if self._rules is None or (now - self._rules_loaded_at).total_seconds() > AD_RULES_REFRESH_SECONDS:
+            rules = self._load_rules()
+            with self._lock:
+                self._rules = rules
+                self._rules_loaded_at = now
+        return self._rules
+
+    def invalidate_rules(self):
+        with self._lock:
+            self._rules = None
+
+    def next_ad(self, now=None, counters=None):
+        """Publicidad que corresponde emitir ahora, o None (con `counters` se evalúa sobre una copia simulada)"""
+        now = now or datetime.utcnow()
+        counters = counters or self.counters()
+        for trigger_type, value, ad in self.rules():
+            if AD_TRIGGERS[trigger_type](counters, value, now):
+                return ad
+        return None
+
+    def record(self, item, now=None):
+        """Actualiza los contadores con el item que acaba de salir al aire"""
+        now = now or datetime.utcnow()
+        counters = self.counters()
+        with self._lock:
+            self.apply(counters, item, now)
+
+    @staticmethod
+    def apply(counters, item, now):
+        if item['type'] == 'ad':
+            counters['tracks_since_ad'] = 0
+            counters['last_ad_at'] = now
+        else:
+            counters['tracks_since_ad'] += 1
+
+ad_scheduler = AdBreakScheduler()
+
+# ===================================
+# ORDEN DE PLAYLISTS
+# ===================================
+
+# Separación entre posiciones consecutivas: deja lugar para insertar entre dos tracks sin mover al resto
+PLAYLIST_POSITION_GAP = 1024
+
+def playlist_append_positions(playlist_id, count=1):
+    """Posiciones para agregar `count` tracks al final de la playlist"""
+    last = db.session.query(db.func.max(PlaylistTrack.position)).filter_by(playlist_id=playlist_id).scalar()
+    start = (last or 0) + PLAYLIST_POSITION_GAP
+    return [start + i * PLAYLIST_POSITION_GAP for i in range(count)]
+
+def rebalance_playlist(playlist_id):
+    """Vuelve a repartir las posiciones cada PLAYLIST_POSITION_GAP, conservando el orden, en una sola sentencia"""
+    ranked = db.select(
+        PlaylistTrack.id,
+        (db.func.row_number().over(order_by=(PlaylistTrack.position, PlaylistTrack.id))
+         * PLAYLIST_POSITION_GAP).label('position')
+    ).where(PlaylistTrack.playlist_id == playlist_id).subquery()
+    db.session.execute(
+        db.update(PlaylistTrack)
+        .where(PlaylistTrack.id == ranked.c.id)
+        .values(position=ranked.c.position)
+        .execution_options(synchronize_session=False)
+    )
+
+def playlist_position_at(playlist_id, index, exclude_id=None):
+    """Posición para que un track quede en el lugar `index` (0 = primero).
+
+    Sólo lee los dos vecinos; si entre ellos ya no queda lugar, rebalancea la playlist
+    y vuelve a calcular. `exclude_id` es la fila que se está moviendo.
+    """
+    for _ in range(2):
+        query = db.session.query(PlaylistTrack.position).filter(PlaylistTrack.playlist_id == playlist_id)
+        if exclude_id is not None:
+            query = query.filter(PlaylistTrack.id != exclude_id)
+        query = query.order_by(PlaylistTrack.position, PlaylistTrack.id)
+        if index <= 0:
+            first = query.limit(1).scalar()
+            return PLAYLIST_POSITION_GAP if first is None else first - PLAYLIST_POSITION_GAP
+
+        neighbours = [position for (position,) in query.offset(index - 1).limit(2)]
+        if not neighbours:
+            break
+        if len(neighbours) == 1:
+            return neighbours[0] + PLAYLIST_POSITION_GAP
+        before, after = neighbours
+        if after - before >= 2:
+            return (before + after) // 2
+        rebalance_playlist(playlist_id)
+
+    return playlist_append_positions(playlist_id)[0]
+
+def new_playlist_position(playlist_id, index=None):
+    """Posición para un track nuevo: al final, o en `index` si se indica"""
+    if index is None:
+        return playlist_append_positions(playlist_id)[0]
+    return playlist_position_at(playlist_id, index)
+
+def move_playlist_track(playlist_id, track_id, index):
+    """Mueve un track al lugar `index` actualizando sólo su fila. Devuelve False si no está en la playlist"""
+    row = PlaylistTrack.query.filter_by(playlist_id=playlist_id, track_id=track_id).first()
+    if row is None:
+        return False
+    row.position = playlist_position_at(playlist_id, index, exclude_id=row.id)
+    return True
+
+def reorder_playlist(playlist_id, track_ids):
+    """Aplica un orden completo nuevo con un único UPDATE ... CASE.
+
+    `track_ids` tiene que contener exactamente los tracks de la playlist; si no, lanza ValueError.
+    """
+    current = {track_id for (track_id,) in db.session.query(PlaylistTrack.track_id).filter_by(playlist_id=playlist_id)}
+    if len(track_ids) != len(set(track_ids)) or set(track_ids) != current:
+        raise ValueError('El nuevo orden debe incluir cada track de la playlist exactamente una vez')
+    if not track_ids:
+        return
+
+    positions = {track_id: (i + 1) * PLAYLIST_POSITION_GAP for i, track_id in enumerate(track_ids)}
+    db.session.execute(
+        db.update(PlaylistTrack)
+        .where(PlaylistTrack.playlist_id == playlist_id)
+        .values(position=db.case(positions, value=PlaylistTrack.track_id, else_=PlaylistTrack.position))
+        .execution_options(synchronize_session=False)
+    )
+
+# ===================================
+# POLÍTICAS DE ROTACIÓN
+# ===================================
+
+# sequential: orden de la playlist; shuffle: permutación nueva en cada ciclo, sin repetir;
+# weighted: permutación donde los tracks menos pasados tienden a salir antes
+ROTATION_MODES = ('sequential', 'shuffle', 'weighted')
+ROTATION_SEPARATE_BY = ('artist', 'album')
+
+def rotation_key(track, separate_by):
+    """Clave de separación del track; sin artista/álbum cada track cuenta como distinto"""
+    value = normalize_track_text(track.get(separate_by))
+    return value or ('track', track['id'])
+
+def separate_rotation(order, slots, key, recent=()):
+    """Reordena para que dos items con la misma clave queden separados por al menos `slots` items.
+
+    En cada lugar sale, entre las claves habilitadas, la que tiene más items pendientes
+    (así las claves grandes no quedan amontonadas al final); a igual cantidad, la del
+    item más temprano del orden recibido. Solo si no hay variedad suficiente se relaja
+    la restricción con la clave que se libera primero. `recent` son las claves que
+    sonaron justo antes (la última al final). O(n log n).
+    """
+    queues = {}
+    for rank, item in enumerate(order):
+        queues.setdefault(key(item), deque()).append((rank, item))
+
+    # Lugar (relativo a este orden) desde el que cada clave reciente vuelve a estar habilitada
+    available = {}
+    for played, k in enumerate(recent, start=-len(recent)):
+        if k in queues:
+            available[k] = played + slots + 1
+
+    # (-items pendientes, rank del próximo item, clave); los rank son únicos, así que nunca se comparan claves
+    ready = [(-len(pending), pending[0][0], k) for k, pending in queues.items() if available.get(k, 0) <= 0]
+    heapq.heapify(ready)
+    # (lugar desde el que vuelve a estar habilitada, rank, clave), en orden de liberación
+    cooling = deque(sorted(
+        ((slot, queues[k][0][0], k) for k, slot in available.items() if slot > 0),
+        key=lambda entry: entry[0]
+    ))
+
+    result = []
+    for slot in range(len(order)):
+        while cooling and cooling[0][0] <= slot:
+            _, rank, k = cooling.popleft()
+            heapq.heappush(ready, (-len(queues[k]), rank, k))
+        if ready:
+            _, _, k = heapq.heappop(ready)
+        else:
+            _, _, k = cooling.popleft()
+        pending = queues[k]
+        result.append(pending.popleft()[1])
+        if pending:
+            cooling.append((slot + slots + 1, pending[0][0], k))
+    return result
+
+def rotation_order(tracks, mode='sequential', rng=None, separation=0, separate_by='artist', play_counts=None,
+                   previous=()):
+    """Orden de reproducción de un ciclo según la política. Determinístico para un mismo `rng`.
+
+    `tracks` son dicts de serialize_track en el orden de la playlist; `play_counts`
+    (track_id -> reproducciones) solo se usa en modo weighted. `previous` es el orden
+    del ciclo anterior: su final cuenta para la separación, y sin separación evita
+    que el último track de un ciclo vuelva a sonar primero en el siguiente.
+    """
+    order = list(tracks)
+    if mode == 'shuffle':
+        rng.shuffle(order)
+    elif mode == 'weighted':
+        # Muestreo ponderado sin reemplazo (Efraimidis-Spirakis): clave u^(1/peso), peso = 1/(1 + reproducciones)
+        play_counts = play_counts or {}
+        keys = [rng.random() ** (1 + play_counts.get(track['id'], 0)) for track in order]
+        order = [track for _, track in sorted(zip(keys, order), key=lambda pair: pair[0], reverse=True)]
+
+    if separation > 0:
+        slots, key = separation, lambda track: rotation_key(track, separate_by)
     else:
-        tracks_since_ad = PlaybackHistory.query.filter(
-            PlaybackHistory.track_id.isnot(None),
-            PlaybackHistory.played_at > last_ad.played_at
-        ).count()
-    
-    # Buscar configuración activa
-    ad_configs = AdConfig.query.filter(
-        AdConfig.is_active == True,
-        AdConfig.trigger_type == 'track_count'
-    ).all()
-    
-    for config in ad_configs:
-        if tracks_since_ad >= config.trigger_value:
-            return Ad.query.get(config.ad_id)
-    
-    return None
+        slots, key = 1, lambda track: track['id']
+    recent = [key(track) for track in previous[-slots:]]
+    if separation > 0 or recent:
+        order = separate_rotation(order, slots, key, recent)
+    return order
+
+def rotation_rng(playlist, cycle):
+    """Generador del ciclo: misma semilla y mismo ciclo dan siempre el mismo orden"""
+    seed = playlist.rotation_seed if playlist.rotation_seed is not None else playlist.id
+    return random.Random(f"{seed}:{cycle}")
+
+# ===================================
+# MOTOR DE ROTACIÓN EN MEMORIA
+# ===================================
+
+def serialize_track(track):
+    """Convierte un Track en el dict que devuelven las APIs de reproducción"""
+    return {
+        'id': track.id,
+        'title': track.title,
+        'artist': track.artist,
+        'album': track.album,
+        'audio_url': track.audio_url,
+        'cover_url': track.cover_url,
+        'duration': track.duration,
+        'gain': loudness_gain(track.loudness, track.peak)
+    }
+
+PlaylistOrder = namedtuple('PlaylistOrder', ['tracks', 'index', 'starts', 'total', 'cycle', 'loaded_at'])
+
+# Relectura periódica de los tracks de cada playlist (duraciones y ganancia corregidas por
+# `flask probe-durations` / `flask analyze-loudness` o cambios hechos desde otro worker)
+ROTATION_REFRESH_SECONDS = 300
+
+# Ciclos ya armados que se guardan por playlist (el actual, el siguiente y los que pida /api/radio/stream)
+ROTATION_CYCLES_CACHED = 4
+
+# Órdenes de ciclo que se conservan por playlist en el estado compartido (el que sonó antes,
+# el actual y los siguientes que ya se pidieron)
+ROTATION_ORDERS_KEPT = 4
+
+def item_duration(item):
+    """Duración efectiva (segundos) de un track o publicidad para la línea de tiempo"""
+    default = DEFAULT_AD_DURATION if item.get('type') == 'ad' else DEFAULT_TRACK_DURATION
+    return item.get('duration') or default
+
+class RotationEngine:
+    """Mantiene en memoria el orden de reproducción de cada playlist y el cursor.
+
+    Cada vuelta completa a la playlist es un ciclo. El orden de un ciclo lo arma
+    una sola vez la política de rotación de la playlist (rotation_order) y después
+    avanzar es mover un índice. Las rutas de administración que modifican la
+    playlist invalidan los órdenes; además se releen como máximo cada
+    ROTATION_REFRESH_SECONDS para tomar cambios hechos desde otros procesos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._orders = {}      # playlist_id -> OrderedDict(ciclo -> PlaylistOrder)
+        self._cycles = {}      # playlist_id -> ciclo en curso
+        self._last_track = {}  # playlist_id -> id del último track entregado
+        self._order_stores = {}  # playlist_id -> estado compartido con los órdenes de cada ciclo
+
+    def _shared_order(self, playlist, cycle, tracks):
+        """Orden del ciclo tal como se emite, compartido por todos los workers.
+
+        El primer proceso que arma un ciclo guarda la lista de ids en el estado
+        compartido y desde ahí todos (también las relecturas) usan esa; solo se
+        vuelve a armar si cambiaron los tracks de la playlist. El final del ciclo
+        anterior que cuenta para la separación se lee de lo guardado, así que es
+        lo que realmente sonó y no se recalcula con el historial de ahora.
+        """
+        store = self._order_stores.get(playlist.id)
+        if store is None:
+            store = self._order_stores[playlist.id] = make_radio_state_store(RADIO_STATE_URL, f'rotation:{playlist.id}')
+        by_id = {track['id']: track for track in tracks}
+        ids = sorted(track['id'] for track in tracks)
+        while True:
+            version, document = store.get_document()
+            orders = (document or {}).get('cycles', {})
+            stored = orders.get(str(cycle))
+            if stored is not None and sorted(stored) == ids:
+                return [by_id[track_id] for track_id in stored]
+
+            previous = orders.get(str(cycle - 1), [])[-max(playlist.rotation_separation, 1):]
+            missing = [track_id for track_id in previous if track_id not in by_id]
+            if missing:
+                # Tracks que sonaron al final del ciclo anterior y ya no están en la playlist
+                by_id.update((track['id'], track) for track in track_cache.get_tracks(missing))
+            play_counts = None
+            if playlist.rotation_mode == 'weighted':
+                play_counts = dict(db.session.query(PlaybackHistory.track_id, db.func.count()).filter(
+                    PlaybackHistory.track_id.in_(
+                        db.select(PlaylistTrack.track_id).where(PlaylistTrack.playlist_id == playlist.id)
+                    )
+                ).group_by(PlaybackHistory.track_id).all())
+            order = rotation_order(tracks, playlist.rotation_mode, rotation_rng(playlist, cycle),
+                                   playlist.rotation_separation, playlist.rotation_separate_by, play_counts,
+                                   [by_id[track_id] for track_id in previous if track_id in by_id])
+
+            orders = dict(orders)
+            orders[str(cycle)] = [track['id'] for track in order]
+            for old in sorted(orders, key=int)[:-ROTATION_ORDERS_KEPT]:
+                del orders[old]
+            if store.compare_and_set_document(version, {'cycles': orders}):
+                return order
+
+    def _load_order(self, playlist_id, cycle):
+        playlist = db.session.get(Playlist, playlist_id)
+        track_ids = [track_id for (track_id,) in db.session.query(PlaylistTrack.track_id).filter(
+            PlaylistTrack.playlist_id == playlist_id
+        ).order_by(PlaylistTrack.position, PlaylistTrack.id)]
+
+        order = track_cache.get_tracks(track_ids)
+        # Secuencial sin separación es el orden de la playlist: no hace falta compartir nada
+        if playlist and order and (playlist.rotation_mode, playlist.rotation_separation) != ('sequential', 0):
+            order = self._shared_order(playlist, cycle, order)
+
+        index = {}
+        starts = []
+        total = 0
+        for i, track in enumerate(order):
+            index.setdefault(track['id'], i)
+            starts.append(total)
+            total += item_duration(track)
+        return PlaylistOrder(order, index, starts, total, cycle, pytime.monotonic())
+
+    def get(self, playlist_id, cycle=None):
+        """Devuelve el PlaylistOrder (tracks, índice y tiempos acumulados) de un ciclo; por defecto el actual"""
+        if cycle is None:
+            cycle = self._cycles.get(playlist_id, 0)
+        cached = self._orders.get(playlist_id, {}).get(cycle)
+        if cached is None or pytime.monotonic() - cached.loaded_at > ROTATION_REFRESH_SECONDS:
+            cached = self._load_order(playlist_id, cycle)
+            with self._lock:
+                cycles = self._orders.setdefault(playlist_id, OrderedDict())
+                cycles[cycle] = cached
+                while len(cycles) > ROTATION_CYCLES_CACHED:
+                    cycles.popitem(last=False)
+        return cached
+
+    def get_order(self, playlist_id, cycle=None):
+        """Devuelve la lista de tracks de la playlist en el orden de reproducción del ciclo"""
+        return self.get(playlist_id, cycle).tracks
+
+    def position(self, playlist_id, track_id):
+        """Índice del track dentro del ciclo actual, o -1 si ya no está"""
+        return self.get(playlist_id).index.get(track_id, -1)
+
+    def _set_cursor(self, playlist_id, cycle, track):
+        with self._lock:
+            self._cycles[playlist_id] = cycle
+            self._last_track[playlist_id] = track['id']
+
+    def seek(self, playlist_id, index, cycle=None):
+        """Coloca el cursor en la posición indicada (del ciclo actual o de `cycle`) y devuelve ese track"""
+        order = self.get(playlist_id, cycle)
+        if not order.tracks:
+            return None
+        track = order.tracks[index % len(order.tracks)]
+        self._set_cursor(playlist_id, order.cycle, track)
+        return track
+
+    def cursor(self, playlist_id):
+        """Índice del último track entregado dentro del ciclo actual, o -1 si no hay cursor"""
+        return self.position(playlist_id, self._last_track.get(playlist_id))
+
+    def tracks_after(self, playlist_id, cycle, index):
+        """Recorre, sin mover el cursor, los tracks que siguen al lugar `index` del ciclo `cycle`
+        (pasando a los ciclos siguientes)"""
+        order = self.get(playlist_id, cycle)
+        while order.tracks:
+            index += 1
+            if index >= len(order.tracks):
+                order, index = self.get(playlist_id, order.cycle + 1), 0
+                if not order.tracks:
+                    return
+            yield order.tracks[index]
+
+    def upcoming(self, playlist_id, n):
+        """Los próximos `n` tracks después del cursor, sin moverlo"""
+        order = self.get(playlist_id)
+        following = self.tracks_after(playlist_id, order.cycle, self.cursor(playlist_id))
+        return list(islice(following, min(n, len(order.tracks))))
+
+    def next_position(self, playlist_id, cycle, index, track_id=None):
+        """(ciclo, índice, track) que sigue al lugar `index` del ciclo `cycle`, sin mover el cursor.
+
+        Si se indica `track_id` (el último track emitido) se lo ubica por id, así una
+        edición de la playlist no corre la rotación. None si la playlist está vacía.
+        """
+        order = self.get(playlist_id, cycle)
+        if not order.tracks:
+            return None
+        index = order.index.get(track_id, index) + 1
+        if index >= len(order.tracks):
+            order, index = self.get(playlist_id, order.cycle + 1), 0
+            if not order.tracks:
+                return None
+        return order.cycle, index, order.tracks[index]
+
+    def invalidate(self, playlist_id):
+        """Descarta los órdenes cacheados; el cursor se conserva por ciclo e id de track"""
+        with self._lock:
+            self._orders.pop(int(playlist_id), None)
+
+rotation_engine = RotationEngine()
+
+# ===================================
+# CACHE DE METADATOS DE TRACKS
+# ===================================
+
+# Cantidad máxima de tracks serializados en memoria y cada cuánto se releen de la base
+TRACK_CACHE_SIZE = 2048
+TRACK_CACHE_TTL = 300
+
+class TrackCacheEntry:
+    __slots__ = ('track', 'body', 'loaded_at')
+
+    def __init__(self, track, body, loaded_at):
+        self.track = track
+        self.body = body
+        self.loaded_at = loaded_at
+
+class TrackMetadataCache:
+    """Cache de lectura de tracks por id: el dict de serialize_track y su JSON ya serializado (bytes).
+
+    Acotada por cantidad (LRU). La usan la rotación (RotationEngine arma cada
+    ciclo con ids) y /api/now-playing. Ninguna ruta web edita tracks existentes;
+    los cambios llegan de comandos flask en otro proceso (probe-durations,
+    analyze-loudness, merge-duplicates) y el TTL los cubre.
+    """
+
+    def __init__(self, max_entries=TRACK_CACHE_SIZE, ttl=TRACK_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, track_ids):
+        """{id: entrada} de los tracks pedidos que existen; los que faltan se leen en una sola consulta"""
+        now = pytime.monotonic()
+        found = {}
+        with self._lock:
+            for track_id in track_ids:
+                entry = self._entries.get(track_id)
+                if entry is not None and now - entry.loaded_at < self.ttl:
+                    self._entries.move_to_end(track_id)
+                    found[track_id] = entry
+
+        missing = {track_id for track_id in track_ids if track_id not in found}
+        if missing:
+            loaded = {}
+            for track in Track.query.filter(Track.id.in_(missing)):
+                data = serialize_track(track)
+                body = json.dumps(dict(data, type='track')).encode('utf-8')
+                loaded[track.id] = TrackCacheEntry(data, body, now)
+            with self._lock:
+                for track_id, entry in loaded.items():
+                    self._entries[track_id] = entry
+                    self._entries.move_to_end(track_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            found.update(loaded)
+        return found
+
+    def get_tracks(self, track_ids):
+        """Dicts de serialize_track en el orden de `track_ids` (se saltean los que no existen)"""
+        entries = self.get_many(track_ids)
+        return [entries[track_id].track for track_id in track_ids if track_id in entries]
+
+    def get_json(self, track_id):
+        """JSON del track (como serialize_track más type='track'), o None si no existe"""
+        entry = self.get_many([track_id]).get(track_id)
+        return entry.body if entry else None
+
+    def invalidate(self, track_id=None):
+        with self._lock:
+            if track_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(track_id, None)
+
+track_cache = TrackMetadataCache()
+
+def json_with(body, **extra):
+    """Agrega campos a un objeto JSON ya serializado sin volver a parsearlo"""
+    if not extra:
+        return body
+    return body[:-1] + b', ' + json.dumps(extra).encode('utf-8')[1:]
+
+# ===================================
+# LÍNEA DE TIEMPO COMPARTIDA
+# ===================================
+
+class HistoryWriter:
+    """Escritura diferida del historial de reproducción.
+
+    Los eventos se encolan en memoria y un hilo en segundo plano los inserta
+    por lotes (INSERT de varias filas) al llegar a HISTORY_BATCH_SIZE o cada
+    HISTORY_FLUSH_SECONDS. Al cerrar el proceso se vacía la cola. Los
+    contadores de publicidad no dependen de estas filas: se actualizan en
+    memoria antes de encolar.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._failed = []
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+
+    def enqueue(self, **row):
+        row.setdefault('played_at', datetime.utcnow())
+        self._ensure_started()
+        self._queue.put(row)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            deadline = pytime.monotonic() + HISTORY_FLUSH_SECONDS
+            while len(batch) < HISTORY_BATCH_SIZE:
+                timeout = deadline - pytime.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    row = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stop = True
+                    break
+                batch.append(row)
+            if batch or self._failed:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        rows = self._failed + batch
+        try:
+            with app.app_context():
+                db.session.execute(db.insert(PlaybackHistory), rows)
+                db.session.commit()
+            self._failed = []
+        except Exception as e:
+            print(f"Error guardando historial ({len(rows)} filas): {e}")
+            # Se reintenta en la próxima pasada, sin crecer indefinidamente
+            self._failed = rows[-HISTORY_BATCH_SIZE * 10:]
+
+    def close(self):
+        """Vacía la cola pendiente y detiene el hilo (se llama al salir del proceso)"""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=HISTORY_FLUSH_SECONDS * 2)
+
+history_writer = HistoryWriter()
+
+def record_playback(item, played_at=None):
+    """Registra en el historial el item que salió al aire en `played_at` (UTC; por defecto ahora)"""
+    played_at = played_at or datetime.utcnow()
+    ad_scheduler.record(item, played_at)
+    if item['type'] == 'ad':
+        row = {'ad_id': item['id'], 'duration_played': item['duration'], 'played_at': played_at}
+    else:
+        row = {'track_id': item['id'], 'duration_played': item['duration'], 'played_at': played_at}
+
+    if HISTORY_ASYNC:
+        history_writer.enqueue(**row)
+    else:
+        db.session.add(PlaybackHistory(**row))
+        db.session.commit()
+
+class BroadcastTimeline:
+    """Línea de tiempo única de la emisión: todos los oyentes escuchan el mismo item con el mismo offset.
+
+    La posición se deriva del horario vigente, el orden de la playlist y las
+    duraciones de los tracks. El estado (item, secuencia, posición en la
+    rotación y contadores de publicidad) vive en el almacén compartido
+    `timeline_state`, así todos los workers ven la misma emisión. Cada proceso
+    sirve su copia en memoria hasta que el item termina; entonces relee el
+    almacén y, si nadie avanzó todavía, calcula la transición y la publica con
+    compare-and-set. Solo el proceso que gana el CAS escribe el historial: una
+    fila por cambio real de item.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._lock = threading.Lock()
+        self._state = None
+
+    @staticmethod
+    def _anchor(now, schedule):
+        """Instante en que arrancó la franja actual (inicio del horario o medianoche)"""
+        start = schedule.start_time if schedule else time.min
+        return datetime.combine(now.date(), start)
+
+    @staticmethod
+    def _utc(local):
+        """Hora UTC de un instante local (los contadores de publicidad se llevan en UTC)"""
+        return local + (datetime.utcnow() - datetime.now())
+
+    def _make_state(self, playlist, anchor, item, seq, started_at, cycle, index, counters):
+        """Estado de un item; `cycle` e `index` son la posición en la rotación del último track emitido"""
+        return {
+            'slot': (playlist.id, anchor),
+            'playlist': playlist.name,
+            'item': item,
+            'item_id': f"{playlist.id}-{anchor:%Y%m%d%H%M}-{seq}",
+            'seq': seq,
+            'started_at': started_at,
+            'ends_at': started_at + timedelta(seconds=item_duration(item)),
+            'cycle': cycle,
+            'index': index,
+            'track_id': item['id'] if item['type'] == 'track' else None,
+            'counters': counters
+        }
+
+    @staticmethod
+    def _encode(state):
+        return dict(
+            state,
+            slot=[state['slot'][0], state['slot'][1].isoformat()],
+            started_at=state['started_at'].isoformat(),
+            ends_at=state['ends_at'].isoformat(),
+            counters=dict(state['counters'], last_ad_at=state['counters']['last_ad_at'].isoformat())
+        )
+
+    @staticmethod
+    def _decode(data):
+        return dict(
+            data,
+            slot=(data['slot'][0], datetime.fromisoformat(data['slot'][1])),
+            started_at=datetime.fromisoformat(data['started_at']),
+            ends_at=datetime.fromisoformat(data['ends_at']),
+            counters=dict(data['counters'], last_ad_at=datetime.fromisoformat(data['counters']['last_ad_at']))
+        )
+
+    def _step(self, state, playlist):
+        """Estado del item (publicidad o track) que sigue a `state`; no toca historial ni cursores"""
+        playlist_id, anchor = state['slot']
+        counters = dict(state['counters'])
+        cycle, index = state['cycle'], state['index']
+        ad = None
+        if state['item']['type'] == 'track':
+            ad = ad_scheduler.next_ad(self._utc(state['ends_at']), counters)
+        if ad:
+            item = ad
+        else:
+            position = self._engine.next_position(playlist_id, cycle, index, state.get('track_id'))
+            if position is None:
+                return None
+            cycle, index, track = position
+            item = dict(track, type='track')
+        ad_scheduler.apply(counters, item, self._utc(state['ends_at']))
+        next_state = self._make_state(playlist, anchor, item, state['seq'] + 1, state['ends_at'],
+                                      cycle, index, counters)
+        if item['type'] == 'ad':
+            next_state['track_id'] = state.get('track_id')
+        return next_state
+
+    def _start(self, playlist, anchor, previous):
+        """Primer track de una franja; la rotación y los contadores siguen desde `previous` si existe"""
+        if previous and previous['slot'][0] == playlist.id:
+            cycle, index, track_id = previous['cycle'], previous['index'], previous.get('track_id')
+        else:
+            cycle, index, track_id = self._engine.get(playlist.id).cycle, -1, None
+        counters = dict(previous['counters']) if previous else dict(ad_scheduler.counters())
+
+        position = self._engine.next_position(playlist.id, cycle, index, track_id)
+        if position is None:
+            return None
+        cycle, index, track = position
+        item = dict(track, type='track')
+        ad_scheduler.apply(counters, item, self._utc(anchor))
+        return self._make_state(playlist, anchor, item, 0, anchor, cycle, index, counters)
+
+    def _jump(self, state, playlist, now):
+        """Salta directo al track que suena en `now` usando las duraciones del ciclo (sin publicidades);
+        solo cuando hay demasiados items para simular uno por uno"""
+        playlist_id, anchor = state['slot']
+        position = self._engine.next_position(playlist_id, state['cycle'], state['index'], state.get('track_id'))
+        if position is None:
+            return None
+        cycle, start_index, _ = position
+        order = self._engine.get(playlist_id, cycle)
+        n = len(order.tracks)
+        elapsed = max(0.0, (now - state['ends_at']).total_seconds())
+        cycles, in_cycle = divmod(order.starts[start_index] + elapsed, order.total)
+        if cycles:
+            # Todos los ciclos duran lo mismo; solo cambia el orden dentro de cada uno
+            order = self._engine.get(playlist_id, cycle + int(cycles))
+        index = bisect_right(order.starts, in_cycle) - 1
+        skipped = int(cycles) * n + (index - start_index)
+
+        item = dict(order.tracks[index], type='track')
+        counters = dict(state['counters'])
+        counters['tracks_since_ad'] += skipped + 1
+        started_at = now - timedelta(seconds=in_cycle - order.starts[index])
+        return self._make_state(playlist, anchor, item, state['seq'] + 1 + skipped, started_at,
+                                order.cycle, index, counters)
+
+    def _run(self, state, playlist, now):
+        """Transiciones desde `state` hasta el item que suena en `now` (la última es el estado vigente)"""
+        limit = now + timedelta(seconds=TIMELINE_GRACE_SECONDS)
+        transitions = [state]
+        while state['ends_at'] <= limit:
+            if len(transitions) > TIMELINE_SIMULATE_MAX:
+                state = self._jump(state, playlist, now)
+            else:
+                state = self._step(state, playlist)
+            if not state:
+                return []
+            transitions.append(state)
+        return transitions
+
+    def _sync(self, playlist, anchor, now):
+        """Estado vigente según el almacén compartido; si terminó, calcula el siguiente y lo publica (CAS)"""
+        limit = now + timedelta(seconds=TIMELINE_GRACE_SECONDS)
+        while True:
+            version, data = timeline_state.get_document()
+            shared = self._decode(data) if data else None
+            if shared and shared['slot'] == (playlist.id, anchor):
+                if limit < shared['ends_at']:
+                    return shared
+                transitions = self._run(shared, playlist, now)[1:]
+            else:
+                first = self._start(playlist, anchor, shared)
+                transitions = self._run(first, playlist, now) if first else []
+            if not transitions:
+                return None
+
+            state = transitions[-1]
+            if timeline_state.compare_and_set_document(version, self._encode(state)):
+                for transition in transitions[-TIMELINE_MAX_CATCHUP:]:
+                    # Con la hora en que salió al aire, no la de ahora (puede ser una puesta al día)
+                    record_playback(transition['item'], self._utc(transition['started_at']))
+                return state
+
+    def current(self, now=None):
+        """Devuelve el estado vigente (item, offset de referencia, playlist) o None si no hay emisión"""
+        now = now or datetime.now()
+        playlist, schedule = get_current_slot(now)
+        if not playlist:
+            return None
+        anchor = self._anchor(now, schedule)
+
+        state = self._state
+        if (state is not None and state['slot'] == (playlist.id, anchor)
+                and now + timedelta(seconds=TIMELINE_GRACE_SECONDS) < state['ends_at']):
+            return state
+
+        # La base y el almacén se consultan sin el lock: con gevent, tenerlo durante esa
+        # ida y vuelta frenaría a todos los requests del worker
+        state = self._sync(playlist, anchor, now)
+        with self._lock:
+            previous = self._state
+            if (state and previous and previous['slot'] == state['slot']
+                    and previous['seq'] > state['seq']):
+                # Otro hilo ya dejó un estado más nuevo mientras este consultaba
+                return previous
+            changed = state is not None and (previous is None or previous['item_id'] != state['item_id'])
+            self._state = state
+
+        if changed:
+            self._engine.seek(playlist.id, state['index'], state['cycle'])
+            radio_events.publish(state['item_id'], self.document(state, now))
+            now_playing.update(state)
+            if MEDIA_PROXY_ENABLED:
+                media_cache.prefetch(self._engine.upcoming(playlist.id, MEDIA_PREFETCH_COUNT))
+        return state
+
+    def upcoming(self, n, now=None):
+        """Los próximos `n` items (tracks y publicidades) después del actual, sin tocar cursor,
+        contadores ni historial. Cada item lleva el mismo item_id que tendrá al salir al aire;
+        la lista se corta en el próximo cambio de horario."""
+        now = now or datetime.now()
+        state = self.current(now)
+        if not state:
+            return None, []
+
+        playlist, _, next_change = compiled_schedule.lookup(now)
+        items = []
+        prev = state
+        while len(items) < n and prev['ends_at'] < next_change:
+            prev = self._step(prev, playlist)
+            if not prev:
+                break
+            items.append(dict(
+                prev['item'],
+                audio_url=public_audio_url(prev['item']),
+                item_id=prev['item_id'],
+                playlist=prev['playlist'],
+                starts_in=round((prev['started_at'] - now).total_seconds(), 3),
+                started_at=prev['started_at'].isoformat(),
+                ends_at=prev['ends_at'].isoformat()
+            ))
+        return state, items
+
+    def snapshot(self, now=None):
+        """Documento JSON del item actual con su offset para sincronizar al oyente"""
+        now = now or datetime.now()
+        state = self.current(now)
+        if not state:
+            return None
+        return self.document(state, now)
+
+    @staticmethod
+    def document(state, now):
+        offset = max(0.0, (now - state['started_at']).total_seconds())
+        return dict(
+            state['item'],
+            audio_url=public_audio_url(state['item']),
+            item_id=state['item_id'],
+            playlist=state['playlist'],
+            offset=round(offset, 3),
+            remaining=round(max(0.0, (state['ends_at'] - now).total_seconds()), 3),
+            started_at=state['started_at'].isoformat(),
+            ends_at=state['ends_at'].isoformat()
+        )
+
+# ===================================
+# PROXY Y CACHE LOCAL DE AUDIO
+# ===================================
+
+def public_audio_url(item):
+    """URL que recibe el oyente: el proxy local si está activo, si no la URL original"""
+    if MEDIA_PROXY_ENABLED and item.get('type', 'track') == 'track':
+        return f"/media/track/{item['id']}"
+    return item['audio_url']
+
+class AudioCache:
+    """Cache en disco de los audios remotos, acotada por tamaño total (LRU).
+
+    El directorio es la única fuente de verdad: lo comparten todos los workers,
+    cada uso actualiza la fecha de modificación del archivo y el límite se
+    aplica recorriendo el directorio, así vale para el total y no por proceso.
+    Cada track se descarga una sola vez por proceso aunque lo pidan varios
+    oyentes a la vez; el archivo se escribe en un temporal y se renombra al terminar.
+    """
+
+    def __init__(self, directory, max_bytes, max_workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._downloads = {}         # track_id -> threading.Event de la descarga en curso
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='media-prefetch')
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=max_workers * 2))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=max_workers * 2))
+        os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, track_id):
+        return os.path.join(self.directory, f"{track_id}.mp3")
+
+    def cached_path(self, track_id):
+        """Ruta del archivo si ya está en cache (y lo marca como usado), o None"""
+        path = self.path_for(track_id)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _evict(self):
+        """Borra los archivos menos usados hasta que el directorio entre en max_bytes"""
+        with self._evict_lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith('.mp3'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            entries.sort()
+            # El más reciente (el que se acaba de descargar) no se borra nunca
+            for _, size, path in entries[:-1]:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+
+    def _download(self, track_id, url):
+        path = self.path_for(track_id)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            with self.session.get(url, stream=True, timeout=(3.05, 30)) as response:
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._evict()
+        return path
+
+    def fetch(self, track_id, url):
+        """Devuelve la ruta local del track, descargándolo si hace falta"""
+        with self._lock:
+            # Se vuelve a mirar adentro del lock: otro hilo pudo terminar la descarga recién
+            path = self.cached_path(track_id)
+            if path:
+                return path
+            event = self._downloads.get(track_id)
+            owner = event is None
+            if owner:
+                event = self._downloads[track_id] = threading.Event()
+        if not owner:
+            event.wait(timeout=60)
+            return self.cached_path(track_id)
+
+        try:
+            return self._download(track_id, url)
+        finally:
+            with self._lock:
+                self._downloads.pop(track_id, None)
+            event.set()
+
+    def open(self, track_id, url):
+        """Abre el archivo cacheado (descargándolo si hace falta); si otro worker lo desaloja
+        antes de abrirlo, lo vuelve a bajar una vez"""
+        for _ in range(2):
+            path = self.fetch(track_id, url)
+            if path:
+                try:
+                    return open(path, 'rb')
+                except FileNotFoundError:
+                    pass
+        raise FileNotFoundError(self.path_for(track_id))
+
+    def _prefetch_one(self, track_id, url):
+        try:
+            self.fetch(track_id, url)
+        except Exception as e:
+            print(f"Error precargando track {track_id}: {e}")
+
+    def prefetch(self, tracks):
+        """Descarga en segundo plano los tracks que todavía no están en cache"""
+        for track in tracks:
+            if track['id'] not in self._downloads and not self.cached_path(track['id']):
+                self._executor.submit(self._prefetch_one, track['id'], track['audio_url'])
+
+media_cache = AudioCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_BYTES) if MEDIA_PROXY_ENABLED else None
+
+@app.route('/media/track/<int:track_id>')
+def media_track(track_id):
+    """Sirve el audio del track desde la cache local (con soporte de Range)"""
+    if not MEDIA_PROXY_ENABLED:
+        abort(404)
+
+    path = media_cache.cached_path(track_id)
+    track = None
+    for _ in range(2):
+        if not path:
+            track = track or Track.query.get_or_404(track_id)
+            try:
+                path = media_cache.fetch(track_id, track.audio_url)
+            except Exception as e:
+                print(f"Error descargando track {track_id}: {e}")
+                path = None
+            if not path:
+                break
+        # conditional=True responde Range/If-Modified-Since; el cuerpo sale por
+        # wsgi.file_wrapper (sendfile en gunicorn) sin copiar el archivo a Python
+        try:
+            return send_file(path, mimetype='audio/mpeg', conditional=True, max_age=86400)
+        except FileNotFoundError:
+            # Otro worker lo desalojó entre la consulta y la apertura: se vuelve a bajar
+            path = None
+
+    # Si el origen falla, que el oyente intente directo
+    track = track or Track.query.get_or_404(track_id)
+    return redirect(track.audio_url)
+
+# ===================================
+# EVENTOS EN VIVO (SERVER-SENT EVENTS)
+# ===================================
+
+# Cada cuánto se manda un comentario vacío para mantener viva la conexión SSE
+SSE_KEEPALIVE_SECONDS = 15
+# Máximo de mensajes pendientes por oyente antes de descartar los más nuevos
+SSE_QUEUE_SIZE = 16
+
+class EventBroadcaster:
+    """Reparte cada cambio de item a todos los oyentes conectados por SSE"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event_id, data):
+        """Formatea el mensaje una sola vez y lo encola para cada suscriptor"""
+        message = f"id: {event_id}\nevent: now-playing\ndata: {json.dumps(data)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                pass  # Cliente lento: recibirá el siguiente cambio
+
+radio_events = EventBroadcaster()
+
+NowPlayingDocument = namedtuple('NowPlayingDocument', ['item_id', 'body', 'ends_at'])
+
+class NowPlaying:
+    """Documento de /api/now-playing ya serializado; se reemplaza en cada cambio de item"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._doc = None
+
+    def update(self, state):
+        item = state['item']
+        body = track_cache.get_json(item['id']) if item['type'] == 'track' else None
+        if body is None:
+            body = json.dumps(dict(item, played_at=state['started_at'].isoformat())).encode('utf-8')
+        else:
+            body = json_with(body, played_at=state['started_at'].isoformat())
+        with self._lock:
+            self._doc = NowPlayingDocument(state['item_id'], body, state['ends_at'])
+
+    def get(self):
+        return self._doc
+
+now_playing = NowPlaying()
+broadcast_timeline = BroadcastTimeline(rotation_engine)
+
+_ticker_lock = threading.Lock()
+_ticker_thread = None
+
+def _timeline_ticker():
+    """Avanza la línea de tiempo en cada corte aunque ningún oyente haga polling"""
+    while True:
+        delay = 5
+        try:
+            with app.app_context():
+                state = broadcast_timeline.current()
+                if state:
+                    delay = (state['ends_at'] - datetime.now()).total_seconds()
+        except Exception as e:
+            print(f"Error en el ticker de la radio: {e}")
+        pytime.sleep(min(max(delay, 0.5), 30))
+
+def ensure_timeline_ticker():
+    """Arranca (una sola vez por proceso) el hilo que publica los cambios de item"""
+    global _ticker_thread
+    with _ticker_lock:
+        if _ticker_thread is None:
+            _ticker_thread = threading.Thread(target=_timeline_ticker, name='radio-ticker', daemon=True)
+            _ticker_thread.start()
+
+# ===================================
+# UTILIDADES MP3
+# ===================================
+
+# kbps por índice, según (es MPEG-1, bits de capa); capa 3 = Layer I, 2 = Layer II, 1 = Layer III
+MP3_BITRATES = {
+    (True, 3): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 1): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 3): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 1): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Hz por índice, según los bits de versión (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+Mp3Frame = namedtuple('Mp3Frame', ['length', 'seconds', 'bitrate', 'sample_rate', 'samples', 'mpeg1', 'mono'])
+
+def mp3_frame_header(buf, i):
+    """Lee la cabecera de frame en buf[i:i+4]; devuelve un Mp3Frame o None"""
+    if buf[i] != 0xFF or (buf[i + 1] & 0xE0) != 0xE0:
+        return None
+    version = (buf[i + 1] >> 3) & 3
+    layer = (buf[i + 1] >> 1) & 3
+    bitrate_index = buf[i + 2] >> 4
+    rate_index = (buf[i + 2] >> 2) & 3
+    padding = (buf[i + 2] >> 1) & 1
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    if layer == 3:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if (mpeg1 or layer == 2) else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    mono = (buf[i + 3] >> 6) == 3
+    return Mp3Frame(length, samples / sample_rate, bitrate, sample_rate, samples, mpeg1, mono)
+
+def iter_mp3_frames(chunks):
+    """Recorre un MP3 (iterable de bloques de bytes) y devuelve sus frames completos
+    como (bytes, segundos), salteando tags ID3 y basura entre frames."""
+    buf = bytearray()
+    skip = 0
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            if skip:
+                n = min(skip, len(buf) - pos)
+                pos += n
+                skip -= n
+                if skip:
+                    break
+            if len(buf) - pos < 10:
+                break
+            if buf[pos:pos + 3] == b'ID3':
+                size = (buf[pos + 6] << 21) | (buf[pos + 7] << 14) | (buf[pos + 8] << 7) | buf[pos + 9]
+                skip = size + (20 if buf[pos + 5] & 0x10 else 10)
+                continue
+            header = mp3_frame_header(buf, pos)
+            if header is None:
+                # Resincronizar en el próximo byte 0xFF
+                next_sync = buf.find(b'\xff', pos + 1)
+                pos = next_sync if next_sync != -1 else len(buf)
+                continue
+            if len(buf) - pos < header.length:
+                break
+            yield bytes(buf[pos:pos + header.length]), header.seconds
+            pos += header.length
+        del buf[:pos]
+
+# Bytes que se leen para encontrar el primer frame y su cabecera Xing/VBRI
+MP3_PROBE_BYTES = 16 * 1024
+
+def _id3v2_size(head):
+    """Largo total del tag ID3v2 al principio de `head` (0 si no hay)"""
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    return size + (20 if head[5] & 0x10 else 10)
+
+def probe_mp3(read, size):
+    """Duración (segundos) y bitrate (kbps) de un MP3 leyendo sólo cabeceras.
+
+    `read(offset, length)` devuelve bytes del archivo y `size` es su largo total.
+    Usa el tag Xing/Info o VBRI si existe (VBR exacto); si no, asume CBR.
+    Devuelve None si no encuentra frames válidos.
+    """
+    start = _id3v2_size(read(0, 10))
+    head = read(start, MP3_PROBE_BYTES)
+
+    # Primer frame válido, confirmado por la cabecera del frame siguiente
+    pos, frame = 0, None
+    while pos <= len(head) - 4:
+        frame = mp3_frame_header(head, pos)
+        if frame:
+            after = pos + frame.length
+            if after + 4 > len(head) or mp3_frame_header(head, after):
+                break
+        next_sync = head.find(b'\xff', pos + 1)
+        if next_sync == -1:
+            return None
+        pos, frame = next_sync, None
+    if frame is None:
+        return None
+
+    audio_start = start + pos
+    frames = total_bytes = None
+    side_info = (17 if frame.mono else 32) if frame.mpeg1 else (9 if frame.mono else 17)
+    xing = pos + 4 + side_info
+    vbri = pos + 4 + 32
+    if head[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(head[xing + 4:xing + 8], 'big')
+        field = xing + 8
+        if flags & 1:
+            frames = int.from_bytes(head[field:field + 4], 'big')
+            field += 4
+        if flags & 2:
+            total_bytes = int.from_bytes(head[field:field + 4], 'big')
+    elif head[vbri:vbri + 4] == b'VBRI':
+        total_bytes = int.from_bytes(head[vbri + 10:vbri + 14], 'big')
+        frames = int.from_bytes(head[vbri + 14:vbri + 18], 'big')
+
+    if frames:
+        duration = frames * frame.samples / frame.sample_rate
+        total_bytes = total_bytes or (size - audio_start)
+        return duration, round(total_bytes * 8 / duration / 1000)
+
+    audio_bytes = size - audio_start
+    if size - audio_start >= 128 and read(size - 128, 3) == b'TAG':
+        audio_bytes -= 128
+    return audio_bytes * 8 / frame.bitrate, frame.bitrate // 1000
+
+def probe_mp3_file(path):
+    """probe_mp3 sobre un archivo local"""
+    with open(path, 'rb') as f:
+        def read(offset, length):
+            f.seek(offset)
+            return f.read(length)
+        return probe_mp3(read, os.path.getsize(path))
+
+_probe_session = requests.Session()
+_probe_session.mount('http://', HTTPAdapter(pool_maxsize=16))
+_probe_session.mount('https://', HTTPAdapter(pool_maxsize=16))
+
+def probe_mp3_url(url):
+    """probe_mp3 sobre una URL remota, pidiendo sólo los rangos de bytes necesarios"""
+    size = None
+
+    def read(offset, length):
+        nonlocal size
+        headers = {'Range': f'bytes={offset}-{offset + length - 1}'}
+        with _probe_session.get(url, headers=headers, stream=True, timeout=(3.05, 15)) as response:
+            response.raise_for_status()
+            if response.status_code == 206:
+                size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                skip = 0
+            else:
+                # El servidor ignoró el Range: se lee el comienzo y se descarta el resto
+                size = int(response.headers.get('Content-Length', 0)) or size
+                skip = offset
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                data += chunk
+                if len(data) >= skip + length:
+                    break
+            return bytes(data[skip:skip + length])
+
+    first = read(0, 10)
+    if not size:
+        return None
+    return probe_mp3(lambda offset, length: first if (offset, length) == (0, 10) else read(offset, length), size)
+
+# ===================================
+# ANÁLISIS DE SONORIDAD
+# ===================================
+
+# Nivel al que se lleva cada item (LUFS) y pico máximo permitido después de aplicar la ganancia (dBFS)
+LOUDNESS_TARGET = -18.0
+LOUDNESS_PEAK_CEILING = -1.0
+# Piso de la compuerta absoluta de BS.1770; también es el valor que se guarda para audio en silencio
+LOUDNESS_FLOOR = -70.0
+LOUDNESS_SAMPLE_RATE = 48000
+FFMPEG_BIN = os.environ.get('FFMPEG_BIN', 'ffmpeg')
+
+# Filtro de ponderación K (ITU-R BS.1770) a 48 kHz: estante de agudos + pasa altos
+K_WEIGHTING = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+)
+
+def loudness_gain(loudness, peak):
+    """Ganancia (dB) para llevar el item a LOUDNESS_TARGET sin pasar el techo de pico; None si no se analizó"""
+    if loudness is None:
+        return None
+    gain = LOUDNESS_TARGET - loudness
+    if peak is not None:
+        gain = min(gain, LOUDNESS_PEAK_CEILING - peak)
+    return round(gain, 2)
+
+# Overlap-save de la ponderación K: bloques FFT de tamaño fijo y respuesta al impulso recortada
+# (los polos del filtro tienen radio ~0.995, a 16k muestras la cola ya es despreciable)
+LOUDNESS_FFT_SIZE = 1 << 16
+LOUDNESS_FIR_TAPS = 1 << 14
+# Audio que se lee de ffmpeg por vez (segundos)
+LOUDNESS_READ_SECONDS = 1
+
+_k_weighting_fft = None
+
+def k_weighting_fft():
+    """rfft de la respuesta al impulso de la ponderación K, lista para overlap-save"""
+    global _k_weighting_fft
+    if _k_weighting_fft is None:
+        import numpy as np
+
+        n = LOUDNESS_FFT_SIZE
+        z = np.exp(-2j * np.pi * np.arange(n // 2 + 1) / n)
+        response = np.ones_like(z)
+        for b, a in K_WEIGHTING:
+            response *= (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+        impulse = np.fft.irfft(response, n=n)[:LOUDNESS_FIR_TAPS]
+        _k_weighting_fft = np.fft.rfft(impulse, n=n)[:, None]
+    return _k_weighting_fft
+
+class LoudnessMeter:
+    """Sonoridad integrada (BS.1770) y pico, midiendo el audio de a pedazos con memoria acotada.
+
+    La ponderación K se aplica por overlap-save en bloques de LOUDNESS_FFT_SIZE
+    y de la señal filtrada solo se guarda la energía de cada sub-bloque de
+    100 ms; los bloques de 400 ms (75% de solapamiento) se arman al final.
+    """
+
+    def __init__(self, channels=2):
+        import numpy as np
+
+        self._np = np
+        self._filter = k_weighting_fft()
+        self._step = LOUDNESS_SAMPLE_RATE // 10
+        self._history = np.zeros((LOUDNESS_FIR_TAPS - 1, channels))
+        self._pending = []        # muestras sin filtrar todavía
+        self._pending_len = 0
+        self._residual = np.zeros((0, channels))  # muestras filtradas que no completan 100 ms
+        self._energy = []         # energía por canal de cada sub-bloque de 100 ms
+        self._peak = 0.0
+
+    def add(self, samples):
+        np = self._np
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.ndim == 1:
+            samples = samples[:, None]
+        if samples.size:
+            self._peak = max(self._peak, float(np.max(np.abs(samples))))
+        self._pending.append(samples)
+        self._pending_len += len(samples)
+
+        block = LOUDNESS_FFT_SIZE - LOUDNESS_FIR_TAPS + 1
+        if self._pending_len >= block:
+            pending = np.concatenate(self._pending)
+            done = len(pending) - len(pending) % block
+            for start in range(0, done, block):
+                self._filter_block(pending[start:start + block])
+            self._pending = [pending[done:]]
+            self._pending_len = len(pending) - done
+
+    def _filter_block(self, samples):
+        np = self._np
+        window = np.concatenate([self._history, samples])
+        spectrum = np.fft.rfft(window, n=LOUDNESS_FFT_SIZE, axis=0) * self._filter
+        weighted = np.fft.irfft(spectrum, n=LOUDNESS_FFT_SIZE, axis=0)
+        weighted = weighted[LOUDNESS_FIR_TAPS - 1:LOUDNESS_FIR_TAPS - 1 + len(samples)]
+        self._history = window[len(window) - (LOUDNESS_FIR_TAPS - 1):]
+
+        weighted = np.concatenate([self._residual, weighted])
+        sub_blocks = len(weighted) // self._step
+        if sub_blocks:
+            used = sub_blocks * self._step
+            self._energy.append((weighted[:used] ** 2).reshape(sub_blocks, self._step, -1).sum(axis=1))
+            weighted = weighted[used:]
+        self._residual = weighted
+
+    def result(self):
+        """(sonoridad LUFS, pico dBFS) de todo lo agregado"""
+        np = self._np
+        if self._pending_len:
+            self._filter_block(np.concatenate(self._pending))
+            self._pending, self._pending_len = [], 0
+        peak_db = float(20 * np.log10(self._peak)) if self._peak > 0 else LOUDNESS_FLOOR
+
+        energy = np.concatenate(self._energy) if self._energy else np.zeros((0, 1))
+        if len(energy) < 4:
+            return LOUDNESS_FLOOR, peak_db
+        windows = np.lib.stride_tricks.sliding_window_view(energy, 4, axis=0).sum(axis=-1)
+        block_power = (windows / (4 * self._step)).sum(axis=1)
+
+        with np.errstate(divide='ignore'):
+            block_loudness = -0.691 + 10 * np.log10(block_power)
+        gated = block_power[block_loudness > LOUDNESS_FLOOR]
+        if not gated.size:
+            return LOUDNESS_FLOOR, peak_db
+        relative_gate = -0.691 + 10 * np.log10(gated.mean()) - 10
+        gated = block_power[(block_loudness > LOUDNESS_FLOOR) & (block_loudness > relative_gate)]
+        return float(-0.691 + 10 * np.log10(gated.mean())), peak_db
+
+def measure_loudness(samples):
+    """Sonoridad integrada (LUFS) y pico de muestra (dBFS) de un array (muestras, canales) a 48 kHz"""
+    import numpy as np
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    meter = LoudnessMeter(channels=samples.shape[1])
+    meter.add(samples)
+    return meter.result()
+
+def decode_pcm(source):
+    """Decodifica un archivo o URL a PCM estéreo float32 a 48 kHz usando ffmpeg, de a pedazos de
+    LOUDNESS_READ_SECONDS (arrays de (muestras, 2))"""
+    import subprocess
+    import numpy as np
+
+    frame = 2 * 4
+    chunk = LOUDNESS_SAMPLE_RATE * LOUDNESS_READ_SECONDS * frame
+    proc = subprocess.Popen(
+        [FFMPEG_BIN, '-nostdin', '-v', 'error', '-i', source, '-vn',
+         '-ac', '2', '-ar', str(LOUDNESS_SAMPLE_RATE), '-f', 'f32le', '-'],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        while True:
+            data = proc.stdout.read(chunk)
+            if not data:
+                break
+            data = data[:len(data) - len(data) % frame]
+            yield np.frombuffer(data, dtype=np.float32).reshape(-1, 2)
+        if proc.wait(timeout=600) != 0:
+            raise RuntimeError(proc.stderr.read().decode('utf-8', 'replace').strip() or 'ffmpeg falló')
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+def analyze_loudness(source):
+    """(sonoridad, pico) de un archivo o URL; corre en los procesos del pool de análisis"""
+    meter = LoudnessMeter(channels=2)
+    for samples in decode_pcm(source):
+        meter.add(samples)
+    return meter.result()
+
+# ===================================
+# STREAM CONTINUO (ESTILO ICECAST)
+# ===================================
+
+# Audio que junta el productor antes de publicarlo en el buffer compartido
+STREAM_CHUNK_SECONDS = 0.5
+# Cuánto audio guarda el buffer circular (lo máximo que un oyente puede atrasarse)
+STREAM_BUFFER_SECONDS = 30
+# Audio que recibe de golpe un oyente nuevo para arrancar sin esperar
+STREAM_BURST_SECONDS = 4
+# Ventaja máxima del productor respecto al reloj real
+STREAM_LEAD_SECONDS = 2
+# Bytes de audio entre bloques de metadatos ICY
+STREAM_ICY_METAINT = 16000
+# Segundos sin oyentes antes de detener el productor
+STREAM_IDLE_SECONDS = 30
+
+def icy_metadata_block(title):
+    """Bloque de metadatos ICY; sin título (None) es un único byte cero"""
+    if title is None:
+        return b'\x00'
+    meta = f"StreamTitle='{title.replace(chr(39), '')}';".encode('utf-8')[:255 * 16]
+    blocks = -(-len(meta) // 16)
+    return bytes([blocks]) + meta.ljust(blocks * 16, b'\x00')
+
+class StreamBuffer:
+    """Buffer circular de bloques de audio con número de secuencia absoluto.
+
+    El productor agrega bloques y cada oyente lee desde su propia secuencia;
+    si se atrasa más que el buffer, salta al bloque más viejo disponible.
+    """
+
+    def __init__(self, maxlen):
+        self._chunks = deque(maxlen=maxlen)
+        self._next_seq = 0
+        self._cond = threading.Condition()
+
+    def append(self, data, title):
+        with self._cond:
+            self._chunks.append((data, title))
+            self._next_seq += 1
+            self._cond.notify_all()
+
+    def start_seq(self, burst):
+        with self._cond:
+            return max(self._next_seq - len(self._chunks), self._next_seq - burst)
+
+    def read(self, seq, timeout):
+        """Devuelve (siguiente seq, (bytes, título)), o (seq, None) si no llegó nada a tiempo"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: seq < self._next_seq, timeout):
+                return seq, None
+            first = self._next_seq - len(self._chunks)
+            seq = max(seq, first)
+            return seq + 1, self._chunks[seq - first]
+
+class LiveStream:
+    """Emisión MP3 continua: un único productor sigue la línea de tiempo de la radio,
+    concatena los frames de cada item y los reparte a todos los oyentes."""
+
+    def __init__(self, timeline):
+        self._timeline = timeline
+        self.buffer = StreamBuffer(int(STREAM_BUFFER_SECONDS / STREAM_CHUNK_SECONDS))
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._listeners = 0
+        self._thread = None
+        self._clock = 0.0
+
+    def ensure_running(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='radio-stream', daemon=True)
+                self._thread.start()
+
+    def listeners(self):
+        with self._lock:
+            return self._listeners
+
+    def _item_chunks(self, item):
+        """Bytes crudos del item: archivo local para publicidades y tracks cacheados, HTTP si no"""
+        if item.get('type') == 'ad':
+            f = open(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], os.path.basename(item['audio_url'])), 'rb')
+        elif MEDIA_PROXY_ENABLED:
+            f = media_cache.open(item['id'], item['audio_url'])
+        else:
+            with self.session.get(item['audio_url'], stream=True, timeout=(3.05, 30)) as response:
+                response.raise_for_status()
+                yield from response.iter_content(chunk_size=64 * 1024)
+            return
+        with f:
+            while True:
+                chunk = f.read(64 * 1024)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _emit(self, data, seconds, title):
+        """Publica un bloque y duerme lo necesario para no adelantarse al reloj real"""
+        now = pytime.monotonic()
+        if self._clock < now:
+            self._clock = now
+        self.buffer.append(bytes(data), title)
+        self._clock += seconds
+        delay = self._clock - pytime.monotonic() - STREAM_LEAD_SECONDS
+        if delay > 0:
+            pytime.sleep(delay)
+
+    def _play(self, state):
+        """Emite el item desde su offset actual hasta que termina o la línea de tiempo cambia"""
+        item = state['item']
+        if item.get('type') == 'ad':
+            title = item['title']
+        else:
+            title = f"{item.get('artist') or 'Artista Desconocido'} - {item['title']}"
+
+        now = datetime.now()
+        offset = max(0.0, (now - state['started_at']).total_seconds())
+        deadline = pytime.monotonic() + (state['ends_at'] - now).total_seconds() + TIMELINE_GRACE_SECONDS
+
+        frames = iter_mp3_frames(self._item_chunks(item))
+        batch, batch_seconds, skipped = bytearray(), 0.0, 0.0
+        try:
+            for frame, seconds in frames:
+                if skipped < offset:
+                    skipped += seconds
+                    continue
+                batch += frame
+                batch_seconds += seconds
+                if batch_seconds >= STREAM_CHUNK_SECONDS:
+                    self._emit(batch, batch_seconds, title)
+                    batch, batch_seconds = bytearray(), 0.0
+                    if pytime.monotonic() > deadline or not self.listeners():
+                        return
+            if batch:
+                self._emit(batch, batch_seconds, title)
+        finally:
+            frames.close()
+
+    def _run(self):
+        idle_since = None
+        last_item_id = None
+        while True:
+            with self._lock:
+                if self._listeners:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = pytime.monotonic()
+                elif pytime.monotonic() - idle_since > STREAM_IDLE_SECONDS:
+                    self._thread = None
+                    return
+
+            try:
+                with app.app_context():
+                    state = self._timeline.current()
+            except Exception as e:
+                print(f"Error consultando la línea de tiempo para el stream: {e}")
+                state = None
+
+            # Si el archivo terminó antes que su duración en la línea de tiempo, esperar el corte
+            if not state or state['item_id'] == last_item_id:
+                pytime.sleep(0.25)
+                continue
+
+            last_item_id = state['item_id']
+            try:
+                self._play(state)
+            except Exception as e:
+                print(f"Error emitiendo {state['item_id']} en el stream: {e}")
+
+    def listen(self, icy=False):
+        """Generador de bytes para un oyente; con `icy` intercala metadatos cada STREAM_ICY_METAINT bytes"""
+        with self._lock:
+            self._listeners += 1
+        self.ensure_running()
+        seq = self.buffer.start_seq(int(STREAM_BURST_SECONDS / STREAM_CHUNK_SECONDS))
+        until_meta = STREAM_ICY_METAINT
+        last_title = None
+        try:
+            while True:
+                seq, chunk = self.buffer.read(seq, timeout=STREAM_IDLE_SECONDS)
+                if chunk is None:
+                    self.ensure_running()
+                    continue
+                data, title = chunk
+                if not icy:
+                    yield data
+                    continue
+
+                out = bytearray()
+                pos = 0
+                while pos < len(data):
+                    n = min(until_meta, len(data) - pos)
+                    out += data[pos:pos + n]
+                    pos += n
+                    until_meta -= n
+                    if until_meta == 0:
+                        out += icy_metadata_block(title if title != last_title else None)
+                        last_title = title
+                        until_meta = STREAM_ICY_METAINT
+                yield bytes(out)
+        finally:
+            with self._lock:
+                self._listeners -= 1
+
+live_stream = LiveStream(broadcast_timeline)
+
+@app.route('/stream.mp3')
+def stream_mp3():
+    """Emisión continua en MP3, compartida por todos los oyentes (compatible con reproductores ICY)"""
+    icy = request.headers.get('Icy-MetaData') == '1'
+    headers = {
+        'Cache-Control': 'no-cache, no-store',
+        'X-Accel-Buffering': 'no',
+        'icy-name': 'Radio Online'
+    }
+    if icy:
+        headers['icy-metaint'] = str(STREAM_ICY_METAINT)
+    return Response(live_stream.listen(icy), mimetype='audio/mpeg', headers=headers)
 
 # ===================================
 # RUTAS PÚBLICAS
@@ -400,77 +2616,79 @@ def logout():
 
 @app.route('/api/current-track')
 def api_current_track():
-    """Devuelve la siguiente canción o publicidad a reproducir"""
-    
-    # Verificar si debe reproducirse un ad
-    ad = should_play_ad()
-    if ad:
-        # Registrar reproducción del ad
-        history = PlaybackHistory(ad_id=ad.id, duration_played=ad.duration)
-        db.session.add(history)
-        db.session.commit()
-        
-        return jsonify({
-            'type': 'ad',
-            'id': ad.id,
-            'title': ad.title,
-            'audio_url': url_for('static', filename=f'ads/{ad.filename}'),
-            'duration': ad.duration
-        })
-    
-    # Obtener playlist actual
-    playlist = get_current_playlist()
-    if not playlist:
-        return jsonify({'error': 'No hay playlist activa'}), 404
-    
-    # Obtener tracks de la playlist ordenados por posición
-    playlist_tracks = PlaylistTrack.query.filter_by(
-        playlist_id=playlist.id
-    ).order_by(PlaylistTrack.position).all()
-    
-    if not playlist_tracks:
-        return jsonify({'error': 'Playlist vacía'}), 404
-    
-    # Obtener último track reproducido de esta playlist
-    last_history = PlaybackHistory.query.join(
-        Track
-    ).join(
-        PlaylistTrack, PlaylistTrack.track_id == Track.id
-    ).filter(
-        PlaylistTrack.playlist_id == playlist.id
-    ).order_by(PlaybackHistory.played_at.desc()).first()
-    
-    # Determinar siguiente track
-    if last_history:
-        last_track_id = last_history.track_id
-        current_index = next((i for i, pt in enumerate(playlist_tracks) if pt.track_id == last_track_id), -1)
-        next_index = (current_index + 1) % len(playlist_tracks)
-    else:
-        next_index = 0
-    
-    next_track_id = playlist_tracks[next_index].track_id
-    track = Track.query.get(next_track_id)
-
-    # Registrar reproducción
-    history = PlaybackHistory(track_id=track.id, duration_played=track.duration)
-    db.session.add(history)
-    db.session.commit()
-
-    return jsonify({
-        'type': 'track',
-        'id': track.id,
-        'title': track.title,
-        'artist': track.artist,
-        'album': track.album,
-        'audio_url': track.audio_url,
-        'cover_url': track.cover_url,
-        'duration': track.duration,
-        'playlist': playlist.name
+    """Devuelve el item que está sonando en la línea de tiempo compartida y su offset"""
+    doc = broadcast_timeline.snapshot()
+    if not doc:
+        return jsonify({'error': 'No hay playlist activa o la playlist está vacía'}), 404
+    return jsonify(doc)
+
+@app.route('/api/radio/timeline')
+def api_radio_timeline():
+    """Estado de la línea de tiempo: item actual, offset y fin previsto"""
+    doc = broadcast_timeline.snapshot()
+    if not doc:
+        return jsonify({'status': 'offline', 'message': 'No hay programación disponible'})
+    return jsonify(dict(doc, status='playing', server_time=datetime.now().isoformat()))
+
+# Máximo de items que puede pedir /api/radio/upcoming
+UPCOMING_MAX_ITEMS = 10
+
+@app.route('/api/radio/upcoming')
+def api_radio_upcoming():
+    """Próximos items de la emisión para que el reproductor los precargue (no avanza la radio)"""
+    n = max(1, min(request.args.get('n', 1, type=int), UPCOMING_MAX_ITEMS))
+    state, items = broadcast_timeline.upcoming(n)
+    if not state:
+        return jsonify({'error': 'No hay emisión en este momento'}), 404
+    return jsonify({'current': state['item_id'], 'items': items})
+
+@app.route('/api/radio/events')
+def api_radio_events():
+    """Canal SSE: un mensaje por cada cambio de track o publicidad"""
+    ensure_timeline_ticker()
+    # Suscribirse antes de tomar el estado: un cambio que ocurra entre ambos llega por la cola
+    q = radio_events.subscribe()
+    doc = broadcast_timeline.snapshot()
+
+    def stream():
+        try:
+            if doc:
+                yield f"id: {doc['item_id']}\nevent: now-playing\ndata: {json.dumps(doc)}\n\n"
+            while True:
+                try:
+                    yield q.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+        finally:
+            radio_events.unsubscribe(q)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
     })
 
 @app.route('/api/now-playing')
 def api_now_playing():
-    """Devuelve información de la reproducción actual"""
+    """Devuelve información de la reproducción actual (con ETag del item y max-age hasta el corte)"""
+    now = datetime.now()
+    doc = now_playing.get()
+    if doc is None or now >= doc.ends_at:
+        state = broadcast_timeline.current(now)
+        doc = now_playing.get() if state else None
+    if doc is None:
+        return now_playing_from_history()
+
+    if request.if_none_match.contains(doc.item_id):
+        response = Response(status=304)
+    else:
+        response = Response(doc.body, mimetype='application/json')
+    response.set_etag(doc.item_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = max(0, int((doc.ends_at - now).total_seconds()))
+    return response
+
+def now_playing_from_history():
+    """Último item del historial, para cuando no hay emisión en curso"""
     last_played = PlaybackHistory.query.order_by(
         PlaybackHistory.played_at.desc()
     ).first()
@@ -479,14 +2697,10 @@ def api_now_playing():
         return jsonify({'error': 'No hay reproducción actual'}), 404
     
     if last_played.track_id:
-        track = Track.query.get(last_played.track_id)
-        return jsonify({
-            'type': 'track',
-            'title': track.title,
-            'artist': track.artist,
-            'cover_url': track.cover_url,
-            'played_at': last_played.played_at.isoformat()
-        })
+        body = track_cache.get_json(last_played.track_id)
+        if body is None:
+            return jsonify({'error': 'No hay reproducción actual'}), 404
+        return Response(json_with(body, played_at=last_played.played_at.isoformat()), mimetype='application/json')
     else:
         ad = Ad.query.get(last_played.ad_id)
         return jsonify({
@@ -549,6 +2763,7 @@ def create_schedule():
     )
     db.session.add(new_schedule)
     db.session.commit()
+    compiled_schedule.invalidate()
     
     flash('Horario programado con éxito', 'success')
     return redirect(url_for('admin_schedule'))
@@ -562,6 +2777,7 @@ def create_playlist():
     playlist = Playlist(name=name, description=description)
     db.session.add(playlist)
     db.session.commit()
+    compiled_schedule.invalidate()
     
     flash('Playlist creada exitosamente', 'success')
     return redirect(url_for('admin_playlists'))
@@ -572,6 +2788,7 @@ def delete_playlist(playlist_id):
     playlist = Playlist.query.get_or_404(playlist_id)
     playlist.is_active = False
     db.session.commit()
+    compiled_schedule.invalidate()
     
     flash('Playlist eliminada exitosamente', 'success')
     return redirect(url_for('admin_playlists'))
@@ -579,8 +2796,235 @@ def delete_playlist(playlist_id):
 @app.route('/admin/tracks')
 @login_required
 def admin_tracks():
-    tracks = Track.query.filter_by(is_active=True).all()
-    return render_template('tracks.html', tracks=tracks)
+    # La tabla se completa de a páginas desde /api/tracks
+    return render_template('tracks.html')
+
+# Tamaño de página por defecto y máximo de /api/tracks
+TRACKS_PAGE_SIZE = 50
+TRACKS_PAGE_MAX = 200
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor, *types):
+    """Decodifica un cursor de encode_cursor; con `types` exige una lista de esos tipos
+    (o un único valor si se pasa un solo tipo) y si no, 400"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError):
+        abort(400)
+    if types:
+        fields = [values] if len(types) == 1 else values
+        if not isinstance(fields, list) or len(fields) != len(types) or not all(
+                isinstance(value, kind) and not isinstance(value, bool) for value, kind in zip(fields, types)):
+            abort(400)
+    return values
+
+# ===================================
+# BÚSQUEDA EN LA BIBLIOTECA
+# ===================================
+
+# Cada cuánto se incorporan los tracks nuevos y cada cuánto se reconstruye todo el índice en memoria
+SEARCH_INDEX_REFRESH_SECONDS = 2
+SEARCH_INDEX_REBUILD_SECONDS = 3600
+# Máximo de términos que expande un prefijo (evita recorrer medio índice con una sola letra)
+SEARCH_PREFIX_EXPANSION = 100
+# Similitud mínima de trigramas para aceptar un término con errores de tipeo
+SEARCH_TRIGRAM_THRESHOLD = 0.3
+
+def search_tokens(text, strip_accents=True):
+    """Palabras normalizadas (minúsculas y, salvo `strip_accents=False`, sin acentos) de un texto"""
+    if strip_accents:
+        text = unicodedata.normalize('NFKD', text or '')
+        text = ''.join(c for c in text if not unicodedata.combining(c))
+    else:
+        text = unicodedata.normalize('NFC', text or '')
+    return re.findall(r'\w+', text.lower())
+
+def token_trigrams(token):
+    padded = f"^{token}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrackSearchIndex:
+    """Índice invertido en memoria sobre título/artista/álbum para motores sin texto completo.
+
+    Cada término apunta a {track_id: peso del campo}. Las búsquedas combinan
+    coincidencia exacta, por prefijo y, si un término no aparece, por
+    similitud de trigramas. Los tracks nuevos se incorporan leyendo solo
+    los ids mayores al último indexado; cada SEARCH_INDEX_REBUILD_SECONDS se
+    reconstruye completo para reflejar ediciones y bajas.
+    """
+
+    FIELD_WEIGHTS = (('title', 3), ('artist', 2), ('album', 1))
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+        self._built_at = None
+        self._checked_at = 0.0
+
+    def _reset(self):
+        self._postings = {}
+        self._terms = []
+        self._terms_sorted = True
+        self._trigrams = {}
+        self._max_id = 0
+
+    def _add(self, track_id, values):
+        for value, (_, weight) in zip(values, self.FIELD_WEIGHTS):
+            for token in search_tokens(value):
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    self._terms.append(token)
+                    self._terms_sorted = False
+                    for trigram in token_trigrams(token):
+                        self._trigrams.setdefault(trigram, set()).add(token)
+                if postings.get(track_id, 0) < weight:
+                    postings[track_id] = weight
+        self._max_id = max(self._max_id, track_id)
+
+    def refresh(self):
+        """Incorpora los tracks nuevos (o reconstruye todo si el índice es viejo)"""
+        now = pytime.monotonic()
+        if now - self._checked_at < SEARCH_INDEX_REFRESH_SECONDS:
+            return
+        rebuild = self._built_at is None or now - self._built_at > SEARCH_INDEX_REBUILD_SECONDS
+        rows = db.session.query(Track.id, Track.title, Track.artist, Track.album).filter(
+            Track.is_active == True,
+            Track.id > (0 if rebuild else self._max_id)
+        ).order_by(Track.id).all()
+
+        with self._lock:
+            if rebuild:
+                self._reset()
+                self._built_at = now
+            for track_id, title, artist, album in rows:
+                self._add(track_id, (title, artist, album))
+            if not self._terms_sorted:
+                self._terms.sort()
+                self._terms_sorted = True
+            self._checked_at = now
+
+    def _matches(self, token):
+        """{track_id: puntaje} de un término de la consulta"""
+        matches = {}
+        for track_id, weight in self._postings.get(token, {}).items():
+            matches[track_id] = weight * 3
+
+        i = bisect_left(self._terms, token)
+        expanded = 0
+        while i < len(self._terms) and self._terms[i].startswith(token) and expanded < SEARCH_PREFIX_EXPANSION:
+            term = self._terms[i]
+            if term != token:
+                expanded += 1
+                for track_id, weight in self._postings[term].items():
+                    matches[track_id] = max(matches.get(track_id, 0), weight * 2)
+            i += 1
+
+        if not matches and len(token) >= 3:
+            query_trigrams = token_trigrams(token)
+            shared = {}
+            for trigram in query_trigrams:
+                for term in self._trigrams.get(trigram, ()):
+                    shared[term] = shared.get(term, 0) + 1
+            for term, count in shared.items():
+                similarity = count / (len(query_trigrams) + len(token_trigrams(term)) - count)
+                if similarity >= SEARCH_TRIGRAM_THRESHOLD:
+                    for track_id, weight in self._postings[term].items():
+                        matches[track_id] = max(matches.get(track_id, 0), weight * similarity)
+        return matches
+
+    def search(self, query, limit):
+        """[(track_id, puntaje)] de los tracks que contienen todos los términos, mejor primero"""
+        tokens = search_tokens(query)
+        if not tokens:
+            return []
+        scores = None
+        with self._lock:
+            for token in tokens:
+                matches = self._matches(token)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {track_id: score + matches[track_id] for track_id, score in scores.items() if track_id in matches}
+                if not scores:
+                    return []
+        return heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+
+track_search_index = TrackSearchIndex()
+
+def search_tracks(query, limit):
+    """[(Track, puntaje)] ordenados por relevancia: tsvector + GIN en Postgres, índice en memoria si no"""
+    if db.engine.dialect.name == 'postgresql':
+        # to_tsvector('simple') conserva los acentos, así que la consulta también
+        tokens = search_tokens(query, strip_accents=False)
+        if not tokens:
+            return []
+        tsquery = db.func.to_tsquery(db.literal_column("'simple'::regconfig"), ' & '.join(f"{token}:*" for token in tokens))
+        vector = track_search_vector(Track.title, Track.artist, Track.album)
+        rank = db.func.ts_rank(vector, tsquery)
+        return db.session.query(Track, rank).filter(
+            Track.is_active == True,
+            vector.op('@@')(tsquery)
+        ).order_by(rank.desc(), Track.id).limit(limit).all()
+
+    track_search_index.refresh()
+    ranked = track_search_index.search(query, limit)
+    tracks = {track.id: track for track in Track.query.filter(Track.id.in_([track_id for track_id, _ in ranked])).all()}
+    return [(tracks[track_id], score) for track_id, score in ranked if track_id in tracks]
+
+@app.route('/api/tracks/search')
+@login_required
+def api_tracks_search():
+    """Búsqueda rankeada en la biblioteca local por título, artista o álbum"""
+    query = request.args.get('q', '').strip()
+    limit = max(1, min(request.args.get('limit', 20, type=int), TRACKS_PAGE_MAX))
+    started = pytime.perf_counter()
+    results = search_tracks(query, limit)
+    return jsonify({
+        'tracks': [dict(serialize_track(track), score=round(float(score), 4)) for track, score in results],
+        'took_ms': round((pytime.perf_counter() - started) * 1000, 2)
+    })
+
+@app.route('/api/tracks')
+@login_required
+def api_tracks():
+    """Biblioteca paginada por keyset (sort=id o sort=title) con filtro `q` sobre título/artista/álbum"""
+    sort = request.args.get('sort', 'id')
+    limit = max(1, min(request.args.get('limit', TRACKS_PAGE_SIZE, type=int), TRACKS_PAGE_MAX))
+    query = Track.query.filter(Track.is_active == True)
+
+    q = request.args.get('q', '').strip()
+    if q:
+        # Los comodines de LIKE que escriba el usuario se buscan literalmente
+        escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern = f"%{escaped}%"
+        query = query.filter(db.or_(
+            Track.title.ilike(pattern, escape='\\'), Track.artist.ilike(pattern, escape='\\'),
+            Track.album.ilike(pattern, escape='\\')
+        ))
+
+    after = request.args.get('after')
+    if sort == 'title':
+        if after:
+            title, track_id = decode_cursor(after, str, int)
+            query = query.filter(db.tuple_(Track.title, Track.id) > (title, track_id))
+        query = query.order_by(Track.title, Track.id)
+    else:
+        if after:
+            query = query.filter(Track.id > decode_cursor(after, int))
+        query = query.order_by(Track.id)
+
+    # Se pide una fila de más para saber si hay otra página sin hacer COUNT
+    tracks = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(tracks) > limit:
+        tracks = tracks[:limit]
+        last = tracks[-1]
+        next_cursor = encode_cursor([last.title, last.id] if sort == 'title' else last.id)
+
+    return jsonify({'tracks': [serialize_track(track) for track in tracks], 'next': next_cursor})
 
 @app.route('/admin/tracks/create', methods=['POST'])
 @login_required
@@ -589,10 +3033,25 @@ def create_track():
         title=request.form.get('title'),
         artist=request.form.get('artist'),
         album=request.form.get('album'),
-        duration=int(request.form.get('duration', 0)),
+        duration=int(request.form.get('duration') or 0),
         audio_url=request.form.get('audio_url'),
         cover_url=request.form.get('cover_url')
     )
+    if not track.duration and track.audio_url:
+        # Sin duración cargada: medirla leyendo sólo las cabeceras del MP3 remoto
+        try:
+            probed = probe_mp3_url(track.audio_url)
+            if probed:
+                track.duration = round(probed[0])
+        except (requests.RequestException, ValueError) as e:
+            print(f"Error midiendo la duración de {track.audio_url}: {e}")
+
+    existing = find_duplicate_track(track.title, track.artist, track.audio_url, track.duration)
+    if existing:
+        flash(f'La canción ya está en la biblioteca: "{existing.title}" de {existing.artist or "Artista Desconocido"}', 'error')
+        return redirect(url_for('admin_tracks'))
+    for column, value in track_identity(track.title, track.artist, track.audio_url).items():
+        setattr(track, column, value)
 
     db.session.add(track)
     db.session.commit()
@@ -607,12 +3066,69 @@ def jamendo_search():
     tracks = search_jamendo_tracks(query=query, genre=genre)
     return jsonify({'tracks': tracks})
 
+@app.route('/api/jamendo/cache-stats')
+@login_required
+def jamendo_cache_stats():
+    """Aciertos/fallos de la cache de Jamendo para monitoreo"""
+    return jsonify(jamendo_cache.info())
+
 @app.route('/admin/ads')
 @login_required
 def admin_ads():
     ads = Ad.query.filter_by(is_active=True).all()
     return render_template('ads.html', ads=ads)
 
+# Las publicidades se guardan como nombre-<hash>.mp3: el contenido de una URL nunca cambia
+AD_HASH_LENGTH = 16
+AD_HASHED_NAME = re.compile(r'[\w.-]+-([0-9a-f]{%d})\.mp3' % AD_HASH_LENGTH)
+AD_MEDIA_MAX_AGE = 365 * 24 * 3600
+
+def save_hashed_upload(file, folder):
+    """Guarda el archivo subido con el hash de su contenido en el nombre y devuelve ese nombre"""
+    os.makedirs(folder, exist_ok=True)
+    stem = os.path.splitext(secure_filename(file.filename))[0] or 'ad'
+    digest = hashlib.sha256()
+    tmp_path = os.path.join(folder, f".upload-{threading.get_ident()}.part")
+    with open(tmp_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    filename = f"{stem}-{digest.hexdigest()[:AD_HASH_LENGTH]}.mp3"
+    os.replace(tmp_path, os.path.join(folder, filename))
+    return filename
+
+@app.route('/media/ads/<path:filename>')
+def ad_media(filename):
+    """Audio de publicidades con ETag fuerte, Range y cache de larga duración"""
+    match = AD_HASHED_NAME.fullmatch(filename)
+    # send_from_directory entrega el archivo por wsgi.file_wrapper (sendfile) y responde Range/If-None-Match
+    response = send_from_directory(
+        app.config['UPLOAD_FOLDER'], filename,
+        mimetype='audio/mpeg',
+        conditional=True,
+        etag=match.group(1) if match else True,
+        max_age=AD_MEDIA_MAX_AGE if match else 3600
+    )
+    if match:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/api/ads/active')
+def api_active_ads():
+    """URLs de las publicidades activas, para que el service worker las precargue"""
+    ads = Ad.query.filter_by(is_active=True).all()
+    response = jsonify({'urls': [serialize_ad(ad)['audio_url'] for ad in ads]})
+    response.cache_control.max_age = 60
+    return response
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker servido desde la raíz para que su alcance cubra /media/ads"""
+    response = send_from_directory(os.path.join(app.static_folder, 'js'), 'sw.js', mimetype='application/javascript', max_age=0)
+    response.cache_control.no_cache = True
+    return response
+
 @app.route('/admin/ads/upload', methods=['POST'])
 @login_required
 def upload_ad():
@@ -626,18 +3142,24 @@ def upload_ad():
         return redirect(url_for('admin_ads'))
     
     if file and file.filename.endswith('.mp3'):
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
+        filename = save_hashed_upload(file, app.config['UPLOAD_FOLDER'])
+        duration = int(request.form.get('duration') or DEFAULT_AD_DURATION)
+        try:
+            probed = probe_mp3_file(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            if probed:
+                duration = round(probed[0])
+        except OSError as e:
+            print(f"Error midiendo la duración de {filename}: {e}")
         
         ad = Ad(
             title=request.form.get('title'),
             filename=filename,
-            duration=int(request.form.get('duration', 30)),
+            duration=duration,
             ad_type=request.form.get('ad_type', 'commercial')
         )
         db.session.add(ad)
         db.session.commit()
+        ad_scheduler.invalidate_rules()
         
         flash('Publicidad subida exitosamente', 'success')
     else:
@@ -676,33 +3198,33 @@ def manage_playlist(playlist_id):
 
     current_tracks = db.session.query(Track, PlaylistTrack.position).join(
         PlaylistTrack, Track.id == PlaylistTrack.track_id
-    ).filter(PlaylistTrack.playlist_id == playlist_id).order_by(PlaylistTrack.position).all()
-
-    all_tracks = Track.query.filter_by(is_active=True).all()
+    ).filter(PlaylistTrack.playlist_id == playlist_id).order_by(PlaylistTrack.position, PlaylistTrack.id).all()
 
     total_duration = sum([track[0].duration for track in current_tracks])
 
     return render_template('playlist_manage.html',
                          playlist=playlist,
                          current_tracks=current_tracks,
-                         all_tracks=all_tracks,
                          total_duration=total_duration)
 
 @app.route('/admin/playlists/<int:playlist_id>/add-track', methods=['POST'])
 @login_required
 def add_track_to_playlist(playlist_id):
     track_id = request.form.get('track_id')
+
+    if PlaylistTrack.query.filter_by(playlist_id=playlist_id, track_id=track_id).first():
+        flash('La canción ya está en la playlist', 'error')
+        return redirect(url_for('manage_playlist', playlist_id=playlist_id))
     
-    # Calcular la siguiente posición
-    last_pos = db.session.query(db.func.max(PlaylistTrack.position)).filter_by(playlist_id=playlist_id).scalar() or 0
-    
+    # Al final, o en el lugar pedido si viene 'index'
     new_rel = PlaylistTrack(
         playlist_id=playlist_id,
         track_id=track_id,
-        position=last_pos + 1
+        position=new_playlist_position(playlist_id, request.form.get('index', type=int))
     )
     db.session.add(new_rel)
     db.session.commit()
+    rotation_engine.invalidate(playlist_id)
     
     flash('Canción añadida a la playlist', 'success')
     return redirect(url_for('manage_playlist', playlist_id=playlist_id))
@@ -715,14 +3237,317 @@ def remove_track_from_playlist(playlist_id, track_id):
         track_id=track_id
     ).delete()
     db.session.commit()
+    rotation_engine.invalidate(playlist_id)
     
     flash('Canción removida de la playlist', 'success')
     return redirect(url_for('manage_playlist', playlist_id=playlist_id))
 
+@app.route('/admin/playlists/<int:playlist_id>/rotation', methods=['POST'])
+@login_required
+def update_playlist_rotation(playlist_id):
+    playlist = Playlist.query.get_or_404(playlist_id)
+    mode = request.form.get('rotation_mode', 'sequential')
+    separate_by = request.form.get('rotation_separate_by', 'artist')
+    if mode not in ROTATION_MODES or separate_by not in ROTATION_SEPARATE_BY:
+        flash('Política de rotación inválida', 'error')
+        return redirect(url_for('manage_playlist', playlist_id=playlist_id))
+
+    playlist.rotation_mode = mode
+    playlist.rotation_separate_by = separate_by
+    playlist.rotation_separation = max(0, request.form.get('rotation_separation', 0, type=int))
+    playlist.rotation_seed = request.form.get('rotation_seed', type=int)
+    db.session.commit()
+    rotation_engine.invalidate(playlist_id)
+
+    flash('Rotación actualizada', 'success')
+    return redirect(url_for('manage_playlist', playlist_id=playlist_id))
+
+@app.route('/admin/playlists/<int:playlist_id>/move-track/<int:track_id>', methods=['POST'])
+@login_required
+def move_track_in_playlist(playlist_id, track_id):
+    """Mueve un track al lugar `index` (0 = primero); sólo se actualiza su fila"""
+    index = (request.get_json(silent=True) or {}).get('index', request.form.get('index'))
+    try:
+        index = int(index)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'index inválido'}), 400
+
+    if not move_playlist_track(playlist_id, track_id, index):
+        return jsonify({'error': 'El track no está en la playlist'}), 404
+    db.session.commit()
+    rotation_engine.invalidate(playlist_id)
+    return jsonify({'status': 'success'})
+
+@app.route('/admin/playlists/<int:playlist_id>/reorder', methods=['POST'])
+@login_required
+def reorder_playlist_tracks(playlist_id):
+    """Aplica un orden completo: {"track_ids": [...]} con todos los tracks de la playlist"""
+    Playlist.query.get_or_404(playlist_id)
+    try:
+        track_ids = [int(track_id) for track_id in (request.get_json(silent=True) or {}).get('track_ids')]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'track_ids inválido'}), 400
+
+    try:
+        reorder_playlist(playlist_id, track_ids)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    db.session.commit()
+    rotation_engine.invalidate(playlist_id)
+    return jsonify({'status': 'success', 'count': len(track_ids)})
+
 # ===================================
 # CARGA MASIVA DE CANCIONES DE JAMENDO
 # ===================================
 
+def dialect_insert(model):
+    """INSERT con soporte de ON CONFLICT según el motor (Postgres o SQLite)"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(model)
+
+def bulk_import_tracks(playlist_id, jamendo_tracks):
+    """Importa tracks a una playlist con operaciones por lotes.
+
+    Resuelve los existentes (misma URL, mismo id de Jamendo o misma canción
+    según DuplicateIndex) con una sola consulta, inserta los faltantes en un
+    INSERT de varias filas (ON CONFLICT por audio_url) y agrega a la playlist
+    con posiciones precalculadas en un único statement. No hace commit.
+    Devuelve (agregados, omitidos).
+    """
+    by_url = {}
+    for jtrack in jamendo_tracks:
+        by_url.setdefault(jtrack['audio_url'], dict(
+            jtrack, **track_identity(jtrack['title'], jtrack['artist'], jtrack['audio_url'], jtrack.get('jamendo_id'))
+        ))
+    if not by_url:
+        return 0, 0
+
+    urls = list(by_url)
+    duplicates = DuplicateIndex(list(by_url.values()))
+    ids = {}      # audio_url -> id de track existente
+    aliases = {}  # audio_url -> audio_url de otro candidato del lote que es la misma canción
+    missing = []
+    for url, candidate in by_url.items():
+        ref = duplicates.find(candidate)
+        if isinstance(ref, int):
+            ids[url] = ref
+        elif ref is not None:
+            aliases[url] = ref
+        else:
+            duplicates.add(candidate)
+            missing.append({
+                'title': candidate['title'],
+                'artist': candidate['artist'],
+                'album': candidate.get('album', ''),
+                'duration': candidate['duration'],
+                'audio_url': url,
+                'cover_url': candidate.get('cover_url', ''),
+                'jamendo_id': candidate['jamendo_id'],
+                'dedupe_key': candidate['dedupe_key'],
+                'is_active': True,
+                'created_at': datetime.utcnow()
+            })
+    if missing:
+        stmt = dialect_insert(Track)
+        if stmt is not None:
+            db.session.execute(stmt.values(missing).on_conflict_do_nothing(index_elements=['audio_url']))
+        else:
+            db.session.execute(db.insert(Track), missing)
+        ids.update(db.session.query(Track.audio_url, Track.id).filter(
+            Track.audio_url.in_([row['audio_url'] for row in missing])
+        ).all())
+    for url, canonical_url in aliases.items():
+        if canonical_url in ids:
+            ids[url] = ids[canonical_url]
+
+    track_ids = list(dict.fromkeys(ids[url] for url in urls if url in ids))
+    in_playlist = {
+        track_id for (track_id,) in db.session.query(PlaylistTrack.track_id).filter(
+            PlaylistTrack.playlist_id == playlist_id,
+            PlaylistTrack.track_id.in_(track_ids)
+        )
+    }
+    new_ids = [track_id for track_id in track_ids if track_id not in in_playlist]
+
+    if new_ids:
+        positions = playlist_append_positions(playlist_id, len(new_ids))
+        db.session.execute(db.insert(PlaylistTrack), [
+            {'playlist_id': playlist_id, 'track_id': track_id, 'position': position}
+            for track_id, position in zip(new_ids, positions)
+        ])
+
+    return len(new_ids), len(jamendo_tracks) - len(new_ids)
+
+def jamendo_source(source_type, genre='rock', search_query=''):
+    """Método de JamendoClient y argumentos para cada tipo de fuente de carga masiva"""
+    if source_type == 'genre':
+        return 'by_genre', {'genre': genre}
+    if source_type == 'search':
+        return 'search', {'query': search_query}
+    return 'popular', {}
+
+class ImportJobRunner:
+    """Ejecuta importaciones grandes de Jamendo fuera del request del admin.
+
+    Cada trabajo vive en la tabla import_jobs. El runner pide las páginas de
+    a varias en paralelo, importa cada tanda con bulk_import_tracks y guarda
+    el avance en el mismo commit, así un trabajo interrumpido se retoma desde
+    la última tanda al reiniciar. Mientras corre, renueva updated_at cada
+    IMPORT_JOB_HEARTBEAT_SECONDS aunque una tanda tarde; un trabajo 'running'
+    sin novedades por más de IMPORT_JOB_STALE_SECONDS se considera abandonado
+    (el proceso que lo tenía murió o se colgó) y cada proceso barre la
+    tabla cada IMPORT_JOB_SWEEP_SECONDS y reclama los que encuentre, así un
+    trabajo cortado por un reinicio se retoma aunque no haya otro reinicio.
+    """
+
+    def __init__(self, max_workers=2):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._active = set()  # trabajos encolados o corriendo en este proceso
+        self._sweeper = None
+
+    def submit(self, job_id):
+        with self._lock:
+            if job_id in self._active:
+                return
+            self._active.add(job_id)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='import-job')
+        self._executor.submit(self._run, job_id)
+
+    def _claim(self, job_id):
+        """Marca el trabajo como 'running' solo si nadie más lo está procesando"""
+        stale = datetime.utcnow() - timedelta(seconds=IMPORT_JOB_STALE_SECONDS)
+        claimed = ImportJob.query.filter(
+            ImportJob.id == job_id,
+            db.or_(
+                ImportJob.status == 'queued',
+                db.and_(ImportJob.status == 'running', ImportJob.updated_at < stale)
+            )
+        ).update({'status': 'running', 'updated_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return claimed == 1
+
+    def _heartbeat(self, job_id, stop):
+        """Renueva updated_at hasta que `stop` se active; usa su propia conexión, no la sesión del trabajo"""
+        while not stop.wait(IMPORT_JOB_HEARTBEAT_SECONDS):
+            try:
+                with app.app_context(), db.engine.begin() as conn:
+                    conn.execute(
+                        db.update(ImportJob)
+                        .where(ImportJob.id == job_id, ImportJob.status == 'running')
+                        .values(updated_at=datetime.utcnow())
+                    )
+            except Exception as e:
+                print(f"Error renovando el trabajo de importación {job_id}: {e}")
+
+    def _run(self, job_id):
+        try:
+            self._process(job_id)
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def _process(self, job_id):
+        with app.app_context():
+            if not self._claim(job_id):
+                return
+            stop = threading.Event()
+            threading.Thread(target=self._heartbeat, args=(job_id, stop),
+                             name=f'import-job-{job_id}-heartbeat', daemon=True).start()
+            try:
+                self._import(job_id)
+            finally:
+                stop.set()
+
+    def _import(self, job_id):
+        job = ImportJob.query.get(job_id)
+        method, kwargs = jamendo_source(job.source_type, **json.loads(job.params or '{}'))
+        batch_size = JAMENDO_PAGE_SIZE * jamendo.max_workers
+        try:
+            while job.fetched < job.total:
+                limit = min(batch_size, job.total - job.fetched)
+                calls = [
+                    (method, dict(kwargs, limit=min(JAMENDO_PAGE_SIZE, limit - offset), offset=job.fetched + offset))
+                    for offset in range(0, limit, JAMENDO_PAGE_SIZE)
+                ]
+                tracks = [track for page in jamendo.fetch_many(calls) for track in page]
+
+                added, skipped = bulk_import_tracks(job.playlist_id, tracks)
+                job.added += added
+                job.skipped += skipped
+                job.fetched = job.total if len(tracks) < limit else job.fetched + limit
+                db.session.commit()
+                rotation_engine.invalidate(job.playlist_id)
+            job.status = 'done'
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            job = ImportJob.query.get(job_id)
+            job.status = 'error'
+            job.error = str(e)
+            db.session.commit()
+            print(f"Error en el trabajo de importación {job_id}: {e}")
+
+    def resume_pending(self):
+        """Reencola los trabajos pendientes y los 'running' abandonados (sin avance hace más de
+        IMPORT_JOB_STALE_SECONDS)"""
+        stale = datetime.utcnow() - timedelta(seconds=IMPORT_JOB_STALE_SECONDS)
+        for (job_id,) in db.session.query(ImportJob.id).filter(
+            db.or_(
+                ImportJob.status == 'queued',
+                db.and_(ImportJob.status == 'running', ImportJob.updated_at < stale)
+            )
+        ).order_by(ImportJob.id).all():
+            self.submit(job_id)
+
+    def _sweep(self):
+        while True:
+            pytime.sleep(IMPORT_JOB_SWEEP_SECONDS)
+            try:
+                with app.app_context():
+                    self.resume_pending()
+            except Exception as e:
+                print(f"Error buscando trabajos de importación pendientes: {e}")
+
+    def start_sweeper(self):
+        """Arranca (una sola vez por proceso) el barrido periódico de trabajos pendientes"""
+        with self._lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep, name='import-job-sweeper', daemon=True)
+                self._sweeper.start()
+
+import_jobs = ImportJobRunner()
+
+_services_started = False
+
+@app.before_request
+def start_background_services():
+    """Tareas de arranque que necesitan la DB, una vez por proceso"""
+    global _services_started
+    if _services_started:
+        return
+    _services_started = True
+    import_jobs.start_sweeper()
+    try:
+        import_jobs.resume_pending()
+    except Exception as e:
+        print(f"No se pudieron retomar los trabajos de importación: {e}")
+
+@app.route('/admin/jobs/<int:job_id>')
+@login_required
+def import_job_status(job_id):
+    """Progreso de un trabajo de importación en JSON"""
+    job = ImportJob.query.get_or_404(job_id)
+    return jsonify(job.to_dict())
+
 @app.route('/admin/playlists/<int:playlist_id>/load-jamendo', methods=['POST'])
 @login_required
 def load_jamendo_to_playlist(playlist_id):
@@ -731,6 +3556,20 @@ def load_jamendo_to_playlist(playlist_id):
     genre = request.form.get('genre', 'rock')
     search_query = request.form.get('search_query', '')
     limit = int(request.form.get('limit', 30))
+
+    # Cargas grandes: se encolan como trabajo en segundo plano
+    if limit > JAMENDO_SYNC_LIMIT:
+        job = ImportJob(
+            playlist_id=playlist_id,
+            source_type=source_type,
+            params=json.dumps({'genre': genre, 'search_query': search_query}),
+            total=limit
+        )
+        db.session.add(job)
+        db.session.commit()
+        import_jobs.submit(job.id)
+        flash(f'Importación de {limit} canciones en curso (trabajo #{job.id}, progreso en /admin/jobs/{job.id})', 'success')
+        return redirect(url_for('manage_playlist', playlist_id=playlist_id))
     
     # Obtener tracks según el tipo de fuente
     if source_type == 'popular':
@@ -742,44 +3581,10 @@ def load_jamendo_to_playlist(playlist_id):
     else:
         jamendo_tracks = get_jamendo_popular_tracks(limit=limit)
     
-    added_count = 0
-    for jtrack in jamendo_tracks:
-        # Verificar si el track ya existe en la DB
-        existing_track = Track.query.filter_by(audio_url=jtrack['audio_url']).first()
-        
-        if not existing_track:
-            new_track = Track(
-                title=jtrack['title'],
-                artist=jtrack['artist'],
-                album=jtrack.get('album', ''),
-                duration=jtrack['duration'],
-                audio_url=jtrack['audio_url'],
-                cover_url=jtrack.get('cover_url', '')
-            )
-            db.session.add(new_track)
-            db.session.flush()
-            track_id = new_track.id
-        else:
-            track_id = existing_track.id
-        
-        # Verificar si ya está en la playlist
-        existing_rel = PlaylistTrack.query.filter_by(
-            playlist_id=playlist_id,
-            track_id=track_id
-        ).first()
-        
-        if not existing_rel:
-            last_pos = db.session.query(db.func.max(PlaylistTrack.position)).filter_by(playlist_id=playlist_id).scalar() or 0
-            new_rel = PlaylistTrack(
-                playlist_id=playlist_id,
-                track_id=track_id,
-                position=last_pos + 1
-            )
-            db.session.add(new_rel)
-            added_count += 1
-    
+    added_count, skipped_count = bulk_import_tracks(playlist_id, jamendo_tracks)
     db.session.commit()
-    flash(f'Se agregaron {added_count} canciones de Jamendo a la playlist', 'success')
+    rotation_engine.invalidate(playlist_id)
+    flash(f'Se agregaron {added_count} canciones de Jamendo a la playlist ({skipped_count} ya estaban)', 'success')
     return redirect(url_for('manage_playlist', playlist_id=playlist_id))
 
 @app.route('/admin/schedule/<int:schedule_id>/delete', methods=['POST'])
@@ -789,9 +3594,152 @@ def delete_schedule(schedule_id):
     schedule = Schedule.query.get_or_404(schedule_id)
     db.session.delete(schedule)
     db.session.commit()
+    compiled_schedule.invalidate()
     flash('Horario eliminado exitosamente', 'success')
     return redirect(url_for('admin_schedule'))
 
+# ===================================
+# ESTADO COMPARTIDO DE LA RADIO
+# ===================================
+
+RadioCursor = namedtuple('RadioCursor', ['playlist_id', 'track_index', 'version'])
+
+class SQLRadioStateStore:
+    """Estado en una fila de radio_state; cada cambio es un compare-and-set sobre `version`.
+
+    Usa conexiones propias del engine y no la sesión del request: leer o cambiar el
+    estado compartido no confirma ni mezcla lo que el request tenga pendiente.
+    """
+
+    def __init__(self, key='default'):
+        self.key = key
+
+    def _create(self, conn):
+        insert = dialect_insert(RadioState)
+        if insert is not None:
+            conn.execute(insert.values(key=self.key).on_conflict_do_nothing())
+            return
+        try:
+            with conn.begin_nested():
+                conn.execute(db.insert(RadioState).values(key=self.key))
+        except IntegrityError:
+            pass
+
+    def get(self):
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                db.select(RadioState.playlist_id, RadioState.track_index, RadioState.version)
+                .where(RadioState.key == self.key)
+            ).first()
+            if row is None:
+                self._create(conn)
+                return RadioCursor(None, 0, 0)
+        return RadioCursor(*row)
+
+    def compare_and_set(self, version, playlist_id, track_index):
+        """Guarda el nuevo estado solo si nadie lo cambió desde que se leyó `version`"""
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                db.update(RadioState)
+                .where(RadioState.key == self.key, RadioState.version == version)
+                .values(playlist_id=playlist_id, track_index=track_index,
+                        version=version + 1, updated_at=datetime.utcnow())
+            )
+        return result.rowcount == 1
+
+    def get_document(self):
+        """(versión, documento JSON o None)"""
+        with db.engine.begin() as conn:
+            row = conn.execute(
+                db.select(RadioState.version, RadioState.data).where(RadioState.key == self.key)
+            ).first()
+            if row is None:
+                self._create(conn)
+                return 0, None
+        return row.version, json.loads(row.data) if row.data else None
+
+    def compare_and_set_document(self, version, document):
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                db.update(RadioState)
+                .where(RadioState.key == self.key, RadioState.version == version)
+                .values(data=json.dumps(document), version=version + 1, updated_at=datetime.utcnow())
+            )
+        return result.rowcount == 1
+
+class RedisRadioStateStore:
+    """Mismo contrato que SQLRadioStateStore sobre un hash de Redis (o compatible)"""
+
+    CAS_SCRIPT = """
+        local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+        if version ~= tonumber(ARGV[1]) then return 0 end
+        redis.call('HSET', KEYS[1], 'version', version + 1, 'playlist_id', ARGV[2], 'track_index', ARGV[3])
+        return 1
+    """
+
+    CAS_DOCUMENT_SCRIPT = """
+        local version = tonumber(redis.call('HGET', KEYS[1], 'version') or '0')
+        if version ~= tonumber(ARGV[1]) then return 0 end
+        redis.call('HSET', KEYS[1], 'version', version + 1, 'data', ARGV[2])
+        return 1
+    """
+
+    def __init__(self, url, key='radio:state'):
+        import redis
+        self.key = key
+        self._client = redis.Redis.from_url(url)
+        self._cas = self._client.register_script(self.CAS_SCRIPT)
+        self._cas_document = self._client.register_script(self.CAS_DOCUMENT_SCRIPT)
+
+    def get(self):
+        values = self._client.hgetall(self.key)
+        playlist_id = values.get(b'playlist_id')
+        return RadioCursor(
+            int(playlist_id) if playlist_id else None,
+            int(values.get(b'track_index', 0)),
+            int(values.get(b'version', 0))
+        )
+
+    def compare_and_set(self, version, playlist_id, track_index):
+        return self._cas(keys=[self.key], args=[version, playlist_id or '', track_index]) == 1
+
+    def get_document(self):
+        version, data = self._client.hmget(self.key, 'version', 'data')
+        return int(version or 0), json.loads(data) if data else None
+
+    def compare_and_set_document(self, version, document):
+        return self._cas_document(keys=[self.key], args=[version, json.dumps(document)]) == 1
+
+def make_radio_state_store(url, key='default'):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisRadioStateStore(url, 'radio:state' if key == 'default' else f'radio:{key}')
+    return SQLRadioStateStore(key)
+
+radio_state = make_radio_state_store(RADIO_STATE_URL)
+# Estado de la línea de tiempo (BroadcastTimeline) compartido entre workers
+timeline_state = make_radio_state_store(RADIO_STATE_URL, 'timeline')
+
+def sync_radio_playlist(playlist_id):
+    """Cursor para la playlist vigente; si cambió la playlist, el índice vuelve a 0 (una sola vez)"""
+    while True:
+        cursor = radio_state.get()
+        if cursor.playlist_id == playlist_id:
+            return cursor
+        if radio_state.compare_and_set(cursor.version, playlist_id, 0):
+            return RadioCursor(playlist_id, 0, cursor.version + 1)
+
+def advance_radio(from_index=None, store=None):
+    """Avanza el índice compartido. Con `from_index` avanza solo si el cursor sigue siendo ese,
+    así varios oyentes que avisan el mismo fin de track producen un único avance.
+    Devuelve (cursor, avanzó)."""
+    store = store or radio_state
+    while True:
+        cursor = store.get()
+        if from_index is not None and cursor.track_index != from_index:
+            return cursor, False
+        if store.compare_and_set(cursor.version, cursor.playlist_id, cursor.track_index + 1):
+            return RadioCursor(cursor.playlist_id, cursor.track_index + 1, cursor.version + 1), True
+
 # ===================================
 # API MEJORADA DE RADIO EN VIVO
 # ===================================
@@ -799,25 +3747,19 @@ def delete_schedule(schedule_id):
 @app.route('/api/radio/stream')
 def api_radio_stream():
     """API principal para la radio - devuelve el track actual según horario"""
-    global radio_state
-    
     # Obtener playlist actual según horario
+    # (si no hay horario, get_current_playlist ya devuelve la playlist por defecto)
     playlist = get_current_playlist()
     
     if not playlist:
-        # Si no hay playlist programada, intentar obtener cualquier playlist activa
-        playlist = Playlist.query.filter_by(is_active=True).first()
-        if not playlist:
-            return jsonify({
-                'status': 'offline',
-                'message': 'No hay programación disponible',
-                'type': 'info'
-            })
+        return jsonify({
+            'status': 'offline',
+            'message': 'No hay programación disponible',
+            'type': 'info'
+        })
     
-    # Obtener tracks de la playlist
-    playlist_tracks = PlaylistTrack.query.filter_by(
-        playlist_id=playlist.id
-    ).order_by(PlaylistTrack.position).all()
+    # Obtener tracks de la playlist (orden cacheado en memoria)
+    playlist_tracks = rotation_engine.get_order(playlist.id)
     
     if not playlist_tracks:
         return jsonify({
@@ -828,53 +3770,59 @@ def api_radio_stream():
         })
     
     # Verificar si cambió la playlist (para resetear el índice)
-    if radio_state['current_playlist_id'] != playlist.id:
-        radio_state['current_playlist_id'] = playlist.id
-        radio_state['current_track_index'] = 0
+    cursor = sync_radio_playlist(playlist.id)
     
-    # Obtener el track actual
-    current_index = radio_state['current_track_index'] % len(playlist_tracks)
-    current_track_rel = playlist_tracks[current_index]
-    track = Track.query.get(current_track_rel.track_id)
-    
-    if not track:
-        return jsonify({'status': 'error', 'message': 'Track no encontrado'})
+    # Obtener el track actual: el índice compartido crece sin límite, así que también
+    # indica el ciclo (todos los workers arman el mismo orden para el mismo ciclo)
+    cycle, current_index = divmod(cursor.track_index, len(playlist_tracks))
+    cycle_tracks = rotation_engine.get_order(playlist.id, cycle) or playlist_tracks
+    track = cycle_tracks[current_index % len(cycle_tracks)]
     
     return jsonify({
         'status': 'playing',
         'type': 'track',
-        'id': track.id,
-        'title': track.title,
-        'artist': track.artist or 'Artista Desconocido',
-        'album': track.album or '',
-        'audio_url': track.audio_url,
-        'cover_url': track.cover_url or '/static/images/default-cover.jpg',
-        'duration': track.duration or 180,
+        'id': track['id'],
+        'title': track['title'],
+        'artist': track['artist'] or 'Artista Desconocido',
+        'album': track['album'] or '',
+        'audio_url': public_audio_url(track),
+        'cover_url': track['cover_url'] or '/static/images/default-cover.jpg',
+        'duration': track['duration'] or 180,
+        'gain': track['gain'],
         'playlist': playlist.name,
         'track_index': current_index,
+        'cursor': cursor.track_index,
         'total_tracks': len(playlist_tracks)
     })
 
 @app.route('/api/radio/next', methods=['POST'])
 def api_radio_next():
-    """Avanza al siguiente track de la radio (llamado cuando termina una canción)"""
-    global radio_state
-    radio_state['current_track_index'] += 1
-    radio_state['last_update'] = datetime.now()
-    return jsonify({'status': 'ok', 'next_index': radio_state['current_track_index']})
+    """Avanza al siguiente track de la radio (llamado cuando termina una canción).
+
+    El cliente manda `cursor` (el que recibió de /api/radio/stream): si otro oyente
+    ya avanzó desde ese valor, no se vuelve a avanzar. Sin cursor no se avanza, porque
+    varios oyentes avisando el mismo fin de track avanzarían una vez cada uno.
+    """
+    data = request.get_json(silent=True) or {}
+    from_index = data.get('cursor', request.args.get('cursor'))
+    if isinstance(from_index, bool):
+        from_index = None
+    try:
+        from_index = int(from_index)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'cursor inválido o faltante'}), 400
+    cursor, advanced = advance_radio(from_index)
+    return jsonify({
+        'status': 'ok' if advanced else 'already_advanced',
+        'next_index': cursor.track_index
+    })
 
 @app.route('/api/radio/status')
 def api_radio_status():
     """Devuelve el estado actual de la radio"""
-    playlist = get_current_playlist()
-    
     now = datetime.now()
-    current_schedule = Schedule.query.filter(
-        Schedule.day_of_week == now.weekday(),
-        Schedule.start_time <= now.time(),
-        Schedule.end_time >= now.time(),
-        Schedule.is_active == True
-    ).first()
+    playlist, current_schedule, next_change = compiled_schedule.lookup(now)
+    upcoming = compiled_schedule.upcoming(now)
     
     return jsonify({
         'is_live': playlist is not None,
@@ -883,9 +3831,168 @@ def api_radio_status():
             'start': current_schedule.start_time.strftime('%H:%M') if current_schedule else None,
             'end': current_schedule.end_time.strftime('%H:%M') if current_schedule else None
         } if current_schedule else None,
+        'next_schedule': {
+            'day_of_week': upcoming[0].day_of_week,
+            'start': upcoming[0].start_time.strftime('%H:%M'),
+            'end': upcoming[0].end_time.strftime('%H:%M'),
+            'playlist': upcoming[1].name if upcoming[1] else None,
+            'starts_at': upcoming[2].isoformat()
+        } if upcoming else None,
+        'next_change': next_change.isoformat(),
         'server_time': now.strftime('%Y-%m-%d %H:%M:%S'),
         'day_of_week': now.weekday()
     })
 
+# ===================================
+# COMANDOS DE MANTENIMIENTO
+# ===================================
+
+@app.cli.command('probe-durations')
+@click.option('--all', 'probe_all', is_flag=True, help='Volver a medir también las que ya tienen duración')
+@click.option('--workers', default=8, show_default=True, help='Descargas de cabeceras en paralelo')
+def probe_durations(probe_all, workers):
+    """Mide la duración real de publicidades y tracks leyendo las cabeceras MP3"""
+    ad_query = Ad.query
+    track_query = Track.query
+    if not probe_all:
+        ad_query = ad_query.filter(db.or_(Ad.duration.is_(None), Ad.duration == 0))
+        track_query = track_query.filter(db.or_(Track.duration.is_(None), Track.duration == 0))
+
+    jobs = [(ad, lambda ad=ad: probe_mp3_file(os.path.join(app.config['UPLOAD_FOLDER'], ad.filename)))
+            for ad in ad_query.all()]
+    jobs += [(track, lambda url=track.audio_url: probe_mp3_url(url)) for track in track_query.all()]
+
+    def run(probe):
+        try:
+            return probe(), None
+        except Exception as e:
+            return None, e
+
+    updated = failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (row, _), (probed, error) in zip(jobs, executor.map(run, [probe for _, probe in jobs])):
+            label = f"{type(row).__name__} {row.id}"
+            if not probed:
+                failed += 1
+                print(f"FALLA {label}: {error or 'no se encontraron frames MP3'}")
+                continue
+            duration, bitrate = probed
+            print(f"OK    {label}: {duration:.1f}s, {bitrate} kbps")
+            row.duration = round(duration)
+            updated += 1
+
+    db.session.commit()
+    print(f"{updated} duraciones actualizadas, {failed} fallas")
+
+@app.cli.command('analyze-loudness')
+@click.option('--workers', default=2, show_default=True, help='Procesos de análisis en paralelo')
+@click.option('--limit', default=0, help='Máximo de filas a analizar (0 = todas las pendientes)')
+def analyze_loudness_command(workers, limit):
+    """Analiza sonoridad y pico de publicidades y tracks que todavía no tienen análisis"""
+    from concurrent.futures import ProcessPoolExecutor
+    from importlib.util import find_spec
+
+    # numpy solo lo usa este comando: no es dependencia de la app web (requirements-dev.txt)
+    if find_spec('numpy') is None:
+        raise click.ClickException('analyze-loudness necesita numpy: pip install -r requirements-dev.txt')
+
+    rows = Ad.query.filter(Ad.loudness.is_(None)).all()
+    rows += Track.query.filter(Track.loudness.is_(None), Track.is_active == True).all()
+    if limit:
+        rows = rows[:limit]
+    sources = [
+        os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], row.filename) if isinstance(row, Ad) else row.audio_url
+        for row in rows
+    ]
+
+    analyzed = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyze_loudness, source): row for row, source in zip(rows, sources)}
+        for future, row in futures.items():
+            label = f"{type(row).__name__} {row.id}"
+            try:
+                row.loudness, row.peak = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"FALLA {label}: {e}")
+                continue
+            analyzed += 1
+            print(f"OK    {label}: {row.loudness:.1f} LUFS, pico {row.peak:.1f} dBFS")
+            # Guardar de a tandas: si el comando se corta, lo ya analizado no se repite
+            if analyzed % 20 == 0:
+                db.session.commit()
+
+    db.session.commit()
+    print(f"{analyzed} analizados, {failed} fallas")
+
+def merge_tracks(keep_id, duplicate_ids):
+    """Pasa historial y playlists de los duplicados al track conservado y borra los duplicados"""
+    for duplicate_id in duplicate_ids:
+        PlaybackHistory.query.filter_by(track_id=duplicate_id).update(
+            {'track_id': keep_id}, synchronize_session=False)
+        # Si la playlist ya tiene el track conservado, la fila del duplicado sobra
+        already = db.session.query(PlaylistTrack.playlist_id).filter_by(track_id=keep_id)
+        PlaylistTrack.query.filter(
+            PlaylistTrack.track_id == duplicate_id,
+            PlaylistTrack.playlist_id.in_(already)
+        ).delete(synchronize_session=False)
+        PlaylistTrack.query.filter_by(track_id=duplicate_id).update(
+            {'track_id': keep_id}, synchronize_session=False)
+        Track.query.filter_by(id=duplicate_id).delete(synchronize_session=False)
+
+@app.cli.command('merge-duplicates')
+@click.option('--dry-run', is_flag=True, help='Solo listar los duplicados, sin fusionar')
+def merge_duplicates(dry_run):
+    """Completa las claves de identidad y fusiona los tracks repetidos en el de menor id"""
+    rows = db.session.query(
+        Track.id, Track.title, Track.artist, Track.audio_url, Track.duration, Track.jamendo_id, Track.dedupe_key
+    ).order_by(Track.id).all()
+
+    # Recalcular claves (cambios en la normalización o filas anteriores a estas columnas)
+    for track_id, title, artist, audio_url, duration, jamendo_id, dedupe_key in rows:
+        identity = track_identity(title, artist, audio_url, jamendo_id)
+        if (identity['jamendo_id'], identity['dedupe_key']) != (jamendo_id, dedupe_key) and not dry_run:
+            Track.query.filter_by(id=track_id).update(identity, synchronize_session=False)
+
+    keep_of = {}
+    duplicates = DuplicateIndex([])
+    for track_id, title, artist, audio_url, duration, jamendo_id, _ in rows:
+        candidate = dict(track_identity(title, artist, audio_url, jamendo_id), audio_url=audio_url, duration=duration)
+        keep = duplicates.find(candidate)
+        if keep is None:
+            duplicates.add(candidate, track_id)
+        else:
+            keep_of.setdefault(keep, []).append(track_id)
+            print(f"{'DUPLICADO' if dry_run else 'FUSIONADO'} {track_id} -> {keep}: {artist} - {title}")
+
+    if not dry_run:
+        for keep_id, duplicate_ids in keep_of.items():
+            merge_tracks(keep_id, duplicate_ids)
+        db.session.commit()
+    print(f"{sum(len(ids) for ids in keep_of.values())} duplicados en {len(keep_of)} canciones")
+
+@app.cli.command('rebalance-playlists')
+@click.option('--playlist', 'playlist_id', type=int, help='Rebalancear sólo esta playlist')
+def rebalance_playlists(playlist_id):
+    """Reparte otra vez las posiciones de las playlists (el orden no cambia; pensado para correr periódicamente)"""
+    playlist_ids = [playlist_id] if playlist_id else [pid for (pid,) in db.session.query(Playlist.id).order_by(Playlist.id)]
+    for pid in playlist_ids:
+        rebalance_playlist(pid)
+    db.session.commit()
+    print(f"{len(playlist_ids)} playlists rebalanceadas")
+
+@app.cli.command('rotation-preview')
+@click.argument('playlist_id', type=int)
+@click.option('--cycle', default=0, help='Ciclo a mostrar (cada vuelta completa a la playlist)')
+def rotation_preview(playlist_id, cycle):
+    """Muestra el orden de reproducción que arma la política de la playlist para un ciclo"""
+    playlist = db.session.get(Playlist, playlist_id)
+    if playlist is None:
+        raise click.ClickException(f'No existe la playlist {playlist_id}')
+    print(f"{playlist.name}: {playlist.rotation_mode}, separación {playlist.rotation_separation} "
+          f"por {playlist.rotation_separate_by}, ciclo {cycle}")
+    for i, track in enumerate(rotation_engine.get_order(playlist_id, cycle), start=1):
+        print(f"{i:4d}. {track['artist']} - {track['title']}")
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
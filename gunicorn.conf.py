@@ -0,0 +1,18 @@
+# Configuración de gunicorn para producción
+# El canal SSE (/api/radio/events) mantiene conexiones abiertas por oyente:
+# con workers gevent cada conexión inactiva es un greenlet y no un worker sync.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', '2000'))
+timeout = 120
+keepalive = 75
+
+
+def post_fork(server, worker):
+    # psycopg2 es una extensión en C que gevent no parchea: sin esta espera cooperativa
+    # cada consulta a Postgres bloquea todos los greenlets del worker (incluidas las conexiones SSE)
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
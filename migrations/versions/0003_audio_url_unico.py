@@ -0,0 +1,54 @@
+"""audio_url unico
+
+Convierte el índice de tracks.audio_url en único para permitir
+INSERT ... ON CONFLICT (audio_url) en las importaciones masivas. Antes se
+fusionan los tracks repetidos por URL en el de menor id.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def _merge_duplicate_urls(conn):
+    rows = conn.execute(sa.text('SELECT id, audio_url FROM tracks ORDER BY id')).all()
+    canonical = {}
+    for track_id, audio_url in rows:
+        if audio_url not in canonical:
+            canonical[audio_url] = track_id
+            continue
+        keep = canonical[audio_url]
+        conn.execute(sa.text('UPDATE playback_history SET track_id = :keep WHERE track_id = :dup'),
+                     {'keep': keep, 'dup': track_id})
+        # Si la playlist ya tiene el track conservado, la fila repetida sobra
+        conn.execute(sa.text(
+            'DELETE FROM playlist_tracks WHERE track_id = :dup AND playlist_id IN '
+            '(SELECT playlist_id FROM playlist_tracks WHERE track_id = :keep)'
+        ), {'keep': keep, 'dup': track_id})
+        conn.execute(sa.text('UPDATE playlist_tracks SET track_id = :keep WHERE track_id = :dup'),
+                     {'keep': keep, 'dup': track_id})
+        conn.execute(sa.text('DELETE FROM tracks WHERE id = :dup'), {'dup': track_id})
+
+
+def upgrade():
+    _merge_duplicate_urls(op.get_bind())
+
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_index('ix_tracks_audio_url')
+        batch_op.create_index('ix_tracks_audio_url', ['audio_url'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_index('ix_tracks_audio_url')
+        batch_op.create_index('ix_tracks_audio_url', ['audio_url'], unique=False)
@@ -0,0 +1,32 @@
+"""busqueda de texto completo en tracks
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18 20:58:13.227461
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Solo Postgres: en SQLite la búsqueda usa el índice en memoria de la app
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(
+        "CREATE INDEX ix_tracks_search ON tracks USING gin ("
+        "to_tsvector('simple'::regconfig, coalesce(title, '') || ' ' || coalesce(artist, '') || ' ' || coalesce(album, '')))"
+    )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_tracks_search', table_name='tracks')
@@ -0,0 +1,63 @@
+"""identidad de tracks para detectar duplicados
+
+Agrega tracks.jamendo_id y tracks.dedupe_key ("artista|título"
+normalizados) con sus índices y los completa para las filas existentes.
+La fusión de duplicados ya existentes la hace `flask merge-duplicates`.
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18 21:34:50.118204
+
+"""
+import re
+import unicodedata
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+# Copia de normalize_track_text de app.py al momento de esta migración
+def _normalize(text):
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r'[\(\[].*?[\)\]]', ' ', text)
+    text = re.sub(r'\b(feat|ft|featuring)\b.*', ' ', text)
+    return ' '.join(re.findall(r'\w+', text))
+
+
+def _backfill(conn):
+    rows = conn.execute(sa.text('SELECT id, title, artist, audio_url FROM tracks')).all()
+    for track_id, title, artist, audio_url in rows:
+        match = re.search(r'[?&]trackid=(\d+)', audio_url or '')
+        conn.execute(sa.text('UPDATE tracks SET jamendo_id = :jamendo_id, dedupe_key = :dedupe_key WHERE id = :id'), {
+            'id': track_id,
+            'jamendo_id': match.group(1) if match else None,
+            'dedupe_key': f"{_normalize(artist)}|{_normalize(title)}"[:255]
+        })
+
+
+def upgrade():
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('jamendo_id', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('dedupe_key', sa.String(length=255), nullable=True))
+
+    _backfill(op.get_bind())
+
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.create_index('ix_tracks_jamendo_id', ['jamendo_id'], unique=False)
+        batch_op.create_index('ix_tracks_dedupe_key', ['dedupe_key'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('tracks', schema=None) as batch_op:
+        batch_op.drop_index('ix_tracks_dedupe_key')
+        batch_op.drop_index('ix_tracks_jamendo_id')
+        batch_op.drop_column('dedupe_key')
+        batch_op.drop_column('jamendo_id')
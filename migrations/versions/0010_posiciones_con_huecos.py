@@ -0,0 +1,29 @@
+"""posiciones de playlist con huecos
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18 23:05:12.318402
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+# Igual que PLAYLIST_POSITION_GAP en app.py
+POSITION_GAP = 1024
+
+
+def upgrade():
+    # Las posiciones eran 1, 2, 3...: se separan para poder insertar entre dos tracks sin mover al resto
+    op.execute(sa.text('UPDATE playlist_tracks SET position = position * :gap').bindparams(gap=POSITION_GAP))
+
+
+def downgrade():
+    # El orden relativo se conserva; no hace falta volver a posiciones consecutivas
+    pass
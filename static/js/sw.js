@@ -1,4 +1,6 @@
 const CACHE_NAME = 'radio-online-v1';
+// Publicidades: sus URLs llevan el hash del contenido, así que se sirven siempre desde caché
+const AD_CACHE_NAME = 'radio-online-ads';
 const urlsToCache = [
   '/',
   '/static/css/style.css',
@@ -8,14 +10,35 @@ const urlsToCache = [
   '/static/images/default-cover.jpg'
 ];
 
+// Precarga las publicidades activas y descarta las que ya no están en rotación
+async function precacheAds() {
+  const response = await fetch('/api/ads/active', { cache: 'no-store' });
+  if (!response.ok) return;
+  const { urls } = await response.json();
+  const cache = await caches.open(AD_CACHE_NAME);
+
+  const cached = await cache.keys();
+  await Promise.all(cached
+    .filter((request) => !urls.includes(new URL(request.url).pathname))
+    .map((request) => cache.delete(request)));
+
+  await Promise.all(urls.map(async (url) => {
+    if (!(await cache.match(url))) {
+      await cache.add(url);
+    }
+  }));
+}
+
 // Instalación del Service Worker
 self.addEventListener('install', (event) => {
   event.waitUntil(
     caches.open(CACHE_NAME)
       .then((cache) => {
         console.log('Cache abierto');
-        return cache.addAll(urlsToCache);
+        // Un recurso faltante no debe impedir que el service worker se instale
+        return Promise.all(urlsToCache.map((url) => cache.add(url).catch(() => null)));
       })
+      .then(() => precacheAds().catch((err) => console.log('No se pudieron precargar publicidades:', err)))
   );
 });
 
@@ -25,7 +48,7 @@ self.addEventListener('activate', (event) => {
     caches.keys().then((cacheNames) => {
       return Promise.all(
         cacheNames.map((cacheName) => {
-          if (cacheName !== CACHE_NAME) {
+          if (cacheName !== CACHE_NAME && cacheName !== AD_CACHE_NAME) {
             console.log('Eliminando caché antigua:', cacheName);
             return caches.delete(cacheName);
           }
@@ -37,6 +60,23 @@ self.addEventListener('activate', (event) => {
 
 // Estrategia de caché: Network First con fallback a caché
 self.addEventListener('fetch', (event) => {
+  const url = new URL(event.request.url);
+
+  // Publicidades: cache first (el contenido de cada URL es inmutable)
+  if (url.origin === self.location.origin && url.pathname.startsWith('/media/ads/')) {
+    event.respondWith(
+      caches.open(AD_CACHE_NAME).then((cache) =>
+        cache.match(url.pathname).then((cached) => cached || fetch(event.request).then((response) => {
+          if (response && response.status === 200) {
+            cache.put(url.pathname, response.clone());
+          }
+          return response;
+        }))
+      )
+    );
+    return;
+  }
+
   event.respondWith(
     fetch(event.request)
       .then((response) => {
@@ -61,4 +101,7 @@ self.addEventListener('message', (event) => {
   if (event.data && event.data.type === 'SKIP_WAITING') {
     self.skipWaiting();
   }
+  if (event.data && event.data.type === 'REFRESH_ADS') {
+    event.waitUntil(precacheAds().catch(() => null));
+  }
 });
\ No newline at end of file
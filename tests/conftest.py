@@ -0,0 +1,19 @@
+import os
+import tempfile
+
+# SQLite temporal con las migraciones aplicadas; los procesos que lanzan los tests heredan la variable
+os.environ.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'radio.db'))
+os.environ.setdefault('HISTORY_ASYNC', '0')
+
+import pytest
+from flask_migrate import upgrade
+
+from app import app, db
+
+
+@pytest.fixture(scope='session')
+def database():
+    with app.app_context():
+        upgrade(directory=os.path.join(app.root_path, 'migrations'))
+        yield db
+        db.session.remove()
@@ -0,0 +1,38 @@
+from datetime import datetime
+
+import pytest
+
+# Consultas calientes de reproducción que deben resolverse con índices
+HOT_QUERIES = [
+    ('última publicidad',
+     'SELECT id, played_at FROM playback_history WHERE ad_id IS NOT NULL ORDER BY played_at DESC LIMIT 1', {}),
+    ('canciones desde la última publicidad',
+     'SELECT COUNT(*) FROM playback_history WHERE track_id IS NOT NULL AND played_at > :since',
+     {'since': datetime(2000, 1, 1)}),
+    ('orden de la playlist',
+     'SELECT track_id FROM playlist_tracks WHERE playlist_id = :playlist_id ORDER BY position',
+     {'playlist_id': 1}),
+    ('track por audio_url',
+     'SELECT id FROM tracks WHERE audio_url = :audio_url', {'audio_url': 'https://example.com/a.mp3'}),
+    ('página de tracks por título',
+     'SELECT id FROM tracks WHERE (title, id) > (:title, :id) ORDER BY title, id LIMIT 50',
+     {'title': 'M', 'id': 0}),
+    ('horario vigente',
+     'SELECT id FROM schedules WHERE day_of_week = :day AND start_time <= :t AND end_time >= :t',
+     {'day': 0, 't': '12:00:00'}),
+]
+
+
+@pytest.mark.parametrize('name, sql, params', HOT_QUERIES, ids=[name for name, _, _ in HOT_QUERIES])
+def test_hot_query_uses_an_index(database, name, sql, params):
+    # EXPLAIN sobre la base con las migraciones aplicadas (SQLite o Postgres)
+    with database.engine.connect() as conn:
+        if database.engine.dialect.name == 'sqlite':
+            plan = [row[-1] for row in conn.execute(database.text(f'EXPLAIN QUERY PLAN {sql}'), params)]
+            full_scans = [line for line in plan if line.startswith('SCAN ') and ' USING ' not in line]
+        else:
+            # Con tablas chicas el planner prefiere Seq Scan; se fuerza para ver si el índice es usable
+            conn.execute(database.text('SET enable_seqscan = off'))
+            plan = [row[0] for row in conn.execute(database.text(f'EXPLAIN {sql}'), params)]
+            full_scans = [line for line in plan if 'Seq Scan' in line]
+    assert full_scans == [], plan
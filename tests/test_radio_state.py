@@ -0,0 +1,33 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from app import RADIO_STATE_URL, advance_radio, app, make_radio_state_store
+
+
+def advance_concurrently(key, base, rounds, advances):
+    # Cada proceso avisa todos los fines de track desde `base` con cursor y después avanza sin cursor
+    with app.app_context():
+        store = make_radio_state_store(RADIO_STATE_URL, key)
+        won = sum(advance_radio(index, store)[1] for index in range(base, base + rounds))
+        for _ in range(advances):
+            advance_radio(store=store)
+        return won
+
+
+def test_cursor_converges_across_processes(database):
+    # Clave aparte del estado: el cursor de la radio no se toca
+    processes, rounds, advances = 4, 40, 15
+    store = make_radio_state_store(RADIO_STATE_URL, 'test-convergence')
+    base = store.get().track_index
+    # spawn: cada proceso abre sus propias conexiones en lugar de heredar las del padre
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        won = sum(executor.map(advance_concurrently, *zip(*[('test-convergence', base, rounds, advances)] * processes)))
+
+    assert won == rounds
+    assert store.get().track_index == base + rounds + processes * advances
+
+
+def test_next_requires_a_numeric_cursor(database):
+    client = app.test_client()
+    for body in ({}, {'cursor': 'abc'}, {'cursor': True}, {'cursor': [1]}):
+        assert client.post('/api/radio/next', json=body).status_code == 400
@@ -0,0 +1,96 @@
+import random
+from datetime import datetime
+
+from app import (PlaybackHistory, Playlist, PlaylistTrack, RotationEngine, Track, db, rotation_order,
+                 separate_rotation)
+
+
+def library(artists, per_artist):
+    return [
+        {'id': artist * per_artist + n, 'artist': f'Artista {artist}', 'album': None}
+        for artist in range(artists) for n in range(per_artist)
+    ]
+
+
+def violations(order, slots, key):
+    return [
+        (i, j) for i in range(len(order)) for j in range(i + 1, min(i + slots + 1, len(order)))
+        if key(order[i]) == key(order[j])
+    ]
+
+
+def test_shuffle_separation_holds_for_every_seed():
+    # 6 artistas x 4 tracks con separación 2 siempre tiene solución
+    tracks = library(6, 4)
+    failed = []
+    for seed in range(200):
+        order = rotation_order(tracks, 'shuffle', random.Random(seed), separation=2)
+        assert sorted(track['id'] for track in order) == [track['id'] for track in tracks]
+        if violations(order, 2, lambda track: track['artist']):
+            failed.append(seed)
+    assert failed == []
+
+
+def test_separation_relaxes_only_without_a_valid_order():
+    # Con una clave dominante no hay orden válido: se relaja, pero no se pierden items
+    order = separate_rotation(list('aaaab'), 1, lambda item: item)
+    assert sorted(order) == list('aaaab')
+    assert order[:3] == ['a', 'b', 'a']
+
+
+def test_ties_keep_the_received_order():
+    order = separate_rotation(list('abcabc'), 2, lambda item: item)
+    assert order == list('abcabc')
+
+
+def create_playlist(artists, per_artist, mode, separation, seed=None):
+    playlist = Playlist(name=f'{mode} {artists}x{per_artist}', rotation_mode=mode, rotation_separation=separation,
+                        rotation_seed=seed)
+    db.session.add(playlist)
+    db.session.flush()
+    for position, track in enumerate(library(artists, per_artist)):
+        row = Track(title=f"T{track['id']}", artist=track['artist'], audio_url=f"https://example.com/{playlist.id}/{position}.mp3")
+        db.session.add(row)
+        db.session.flush()
+        db.session.add(PlaylistTrack(playlist_id=playlist.id, track_id=row.id, position=position + 1))
+    db.session.commit()
+    return playlist
+
+
+def aired(engine, playlist_id, cycles):
+    return [track for cycle in range(cycles) for track in engine.get_order(playlist_id, cycle)]
+
+
+def test_separation_holds_across_cycles(database):
+    # Con la misma cantidad de tracks por artista y separación < artistas siempre hay un orden válido,
+    # también en el paso de un ciclo al siguiente
+    rng = random.Random(0)
+    failed = []
+    for seed in range(40):
+        artists = rng.randint(3, 6)
+        separation = rng.randint(1, artists - 1)
+        playlist = create_playlist(artists, rng.randint(1, 4), 'shuffle', separation, seed)
+        order = aired(RotationEngine(), playlist.id, 10)
+        if violations(order, separation, lambda track: track['artist']):
+            failed.append(seed)
+    assert failed == []
+
+
+def test_two_tracks_never_repeat_back_to_back(database):
+    playlist = create_playlist(2, 1, 'shuffle', 0)
+    order = aired(RotationEngine(), playlist.id, 40)
+    assert violations(order, 1, lambda track: track['id']) == []
+
+
+def test_weighted_cycles_are_shared_and_fixed(database):
+    # Otro worker (otro RotationEngine) ve los mismos órdenes aunque el historial cambie después
+    playlist = create_playlist(3, 3, 'weighted', 1)
+    engine = RotationEngine()
+    first = [[track['id'] for track in engine.get_order(playlist.id, cycle)] for cycle in range(3)]
+    for _ in range(20):
+        db.session.add(PlaybackHistory(track_id=first[1][0], played_at=datetime.utcnow()))
+    db.session.commit()
+    engine.invalidate(playlist.id)
+    other = RotationEngine()
+    assert [[track['id'] for track in engine.get_order(playlist.id, cycle)] for cycle in range(3)] == first
+    assert [[track['id'] for track in other.get_order(playlist.id, cycle)] for cycle in range(3)] == first